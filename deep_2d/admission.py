@@ -0,0 +1,139 @@
+import threading
+
+# Admission control for the jobs deep2d enqueues.
+#
+# Every lane gets a number of slots: the most jobs this run keeps queued or running on
+# it at once. A job is only made and enqueued once a slot is free, so a deep run holds
+# its own jobs back instead of flooding the cluster queue and starving everybody else.
+#
+#   class_2D      go to whichever configured lane has the most free slots (relative to
+#                 its size), so a run spreads over every lane it was given
+#   single_select go to select_lane only, and at most max_select of them are in flight;
+#                 they are cheap and are held until they can actually run
+#
+# A slot is taken by acquire() before the job is made, handed to the job by admitted()
+# once it is enqueued, and given back when the watcher sees the job finish.
+#
+#   admission = AdmissionController(watcher, parse_lanes('default:4,gpu2:2'), max_select=8)
+#   lane = admission.acquire('class_2D')
+#   ... make_job / enqueue_job(..., lane) ...
+#   admission.admitted(lane, job_uid, 'class_2D')
+
+
+def parse_lanes(spec):
+  """ 'default:4,gpu2:2' -> [('default', 4), ('gpu2', 2)]; a lane without a count gets 1 slot """
+  lanes = []
+  for item in filter(None, [s.strip() for s in spec.split(',')]):
+    name, _, slots = item.partition(':')
+    slots = int(slots) if slots else 1
+    if slots < 1:
+      raise ValueError('lane %s needs at least one slot' % name)
+    lanes.append((name, slots))
+  if len(lanes) == 0:
+    raise ValueError('no lanes in %r' % spec)
+  return lanes
+
+
+class Lane(object):
+
+  def __init__(self, name, slots):
+    self.name = name
+    self.slots = slots
+    self.reserved = 0
+    self.queued = set()
+    self.running = set()
+    self.peak = 0
+
+  def in_flight(self):
+    return self.reserved + len(self.queued) + len(self.running)
+
+  def free(self):
+    return self.slots - self.in_flight()
+
+
+class AdmissionController(object):
+
+  def __init__(self, watcher, lanes, select_lane=None, max_select=4):
+    self.watcher = watcher
+    self.lanes = [Lane(name, slots) for name, slots in lanes]
+    self.by_name = dict((lane.name, lane) for lane in self.lanes)
+    self.select_lane = self.by_name[select_lane or self.lanes[0].name]
+    self.max_select = max_select
+    self.num_select = 0
+    self.job_types = {}  # job_uid -> job_type of admitted jobs
+    self._cond = threading.Condition()
+
+  def _pick(self, job_type):
+    if job_type == 'class_2D':
+      candidates = [lane for lane in self.lanes if lane.free() > 0]
+      if len(candidates) == 0:
+        return None
+      # ties go to the lane listed first
+      return max(candidates, key=lambda lane: (lane.free() / float(lane.slots), -self.lanes.index(lane)))
+    if self.num_select >= self.max_select or self.select_lane.free() <= 0:
+      return None
+    return self.select_lane
+
+  def acquire(self, job_type):
+    """ block until job_type may be enqueued; returns the lane to put it on """
+    with self._cond:
+      lane = self._pick(job_type)
+      while lane is None:
+        self._cond.wait(1.0)
+        lane = self._pick(job_type)
+      lane.reserved += 1
+      lane.peak = max(lane.peak, lane.in_flight())
+      if job_type != 'class_2D':
+        self.num_select += 1
+      return lane.name
+
+  def cancel(self, lane_name, job_type):
+    """ give back a slot from acquire() when the job could not be made or enqueued """
+    with self._cond:
+      self.by_name[lane_name].reserved -= 1
+      if job_type != 'class_2D':
+        self.num_select -= 1
+      self._cond.notify_all()
+
+  def admitted(self, lane_name, job_uid, job_type):
+    """ the job holding a slot from acquire() is enqueued; its slot is freed when it finishes """
+    with self._cond:
+      lane = self.by_name[lane_name]
+      lane.reserved -= 1
+      lane.queued.add(job_uid)
+      self.job_types[job_uid] = job_type
+    self.watcher.watch(job_uid).add_done_callback(lambda fut: self.release(fut.job_uid))
+
+  def adopt(self, lane_name, job_uid, job_type):
+    """ count a job enqueued before a restart; it may overfill its lane until it finishes """
+    lane = self.by_name.get(lane_name, self.lanes[0])
+    with self._cond:
+      lane.reserved += 1
+      if job_type != 'class_2D':
+        self.num_select += 1
+    self.admitted(lane.name, job_uid, job_type)
+
+  def on_status(self, job_uid, state):
+    """ JobWatcher on_status hook: track which of our jobs have left the queue """
+    if state != 'running':
+      return
+    with self._cond:
+      for lane in self.lanes:
+        if job_uid in lane.queued:
+          lane.queued.discard(job_uid)
+          lane.running.add(job_uid)
+
+  def release(self, job_uid):
+    with self._cond:
+      for lane in self.lanes:
+        if job_uid in lane.queued or job_uid in lane.running:
+          lane.queued.discard(job_uid)
+          lane.running.discard(job_uid)
+          if self.job_types.pop(job_uid, None) != 'class_2D':
+            self.num_select -= 1
+      self._cond.notify_all()
+
+  def summary(self):
+    with self._cond:
+      return ', '.join('%s: %d queued, %d running, peak %d/%d' % (lane.name, len(lane.queued), len(lane.running), lane.peak, lane.slots)
+                       for lane in self.lanes)
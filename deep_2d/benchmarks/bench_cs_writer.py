@@ -0,0 +1,75 @@
+import os
+import sys
+import imp
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+
+import numpy as n
+
+from standins import make_particles, in_subprocess
+
+# Compare the single_select particle output stage:
+#   old : subset_idxs for include and exclude, then filter_prefixes(...).to_file(...) on each
+#   new : cswriter.write_partitioned streaming both partitions from the original dataset
+# Each variant runs in a fresh process; reported are wall time and the peak RSS above
+# the RSS right after the synthetic dataset was built.
+#
+#   python bench_cs_writer.py --num_particles 1000000 10000000
+
+here = os.path.dirname(os.path.abspath(__file__))
+cswriter = imp.load_source('cswriter', os.path.join(here, '..', 'single_select', 'cswriter.py'))
+
+
+def run_old(dset, mask, out_dir):
+  include = dset.subset_idxs(n.where(mask)[0])
+  exclude = dset.subset_idxs(n.where(~mask)[0])
+  include.filter_prefixes(['blob', 'alignments2D']).to_file(os.path.join(out_dir, 'old_selected.cs'))
+  exclude.filter_prefixes(['blob', 'alignments2D']).to_file(os.path.join(out_dir, 'old_excluded.cs'))
+
+
+def run_new(dset, mask, out_dir):
+  cswriter.write_partitioned(dset, mask, os.path.join(out_dir, 'new_selected.cs'), os.path.join(out_dir, 'new_excluded.cs'),
+                             ['blob', 'alignments2D'])
+
+
+def measure(variant, num_particles, out_dir, results):
+  dset = make_particles(num_particles)
+  mask = dset.data['alignments2D/class'] % 3 == 0
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  tic = time.time()
+  {'old': run_old, 'new': run_new}[variant](dset, mask, out_dir)
+  wall = time.time() - tic
+  rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  results.put((variant, wall, (rss_after - rss_before) / 1024.0, dset.data.nbytes / 1024.0 / 1024.0))
+
+
+def check_same(out_dir):
+  for side in ['selected', 'excluded']:
+    old = n.load(os.path.join(out_dir, 'old_%s.cs' % side))
+    new = n.load(os.path.join(out_dir, 'new_%s.cs' % side))
+    assert old.dtype == new.dtype and n.array_equal(old, new), 'outputs differ for %s' % side
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_particles', type=int, nargs='+', default=[100000, 1000000])
+  parser.add_argument('--out_dir', type=str, default=None)
+  args = parser.parse_args()
+
+  out_dir = args.out_dir or tempfile.mkdtemp(prefix='bench_cs_writer_')
+  if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+  try:
+    print('%12s %8s %10s %16s %12s' % ('particles', 'variant', 'wall (s)', 'extra peak (MB)', 'dset (MB)'))
+    for num_particles in args.num_particles:
+      for variant in ['old', 'new']:
+        variant, wall, peak_mb, dset_mb = in_subprocess(measure, variant, num_particles, out_dir)
+        print('%12d %8s %10.2f %16.1f %12.1f' % (num_particles, variant, wall, peak_mb, dset_mb))
+        sys.stdout.flush()
+      check_same(out_dir)
+  finally:
+    if args.out_dir is None:
+      shutil.rmtree(out_dir)
@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+import numpy as n
+
+import standins
+
+# Benchmark of the single_select job on synthetic data, against the stand-ins in standins.py.
+#
+# For every particle count a synthetic class_2D job is written once (and kept in --data_dir
+# for the next run), then, in a fresh process:
+#   setup      load templates and particles, per-class statistics   (run() phases)
+#   upload     render and upload the class images                   (run() phases)
+#   output     render template figures, write the .cs files, read particle previews
+#   selection  selection mask and posterior index on their own, best of 3
+#   endpoints  every interactive endpoint through the flask test client, median of 5, and
+#              its response size as json and gzipped with compact arrays
+#
+# Each run is appended to --results as one JSON line, with the git revision, host and
+# versions. Stages more than --tolerance times slower than the last result for the same
+# host and settings are flagged; --check makes that an error.
+#
+#   python bench_single_select.py --num_particles 100000 1000000 10000000
+
+ENDPOINTS = [('select_all', {}), ('set_prob_thresh', {'prob_thresh': 0.5}), ('select_none', {}),
+             ('set_class_selected', {'class_idx': 1, 'selected': True}), ('select_invert', {}),
+             ('select_above', {'class_idx': 1, 'dimension': 'num_particles_total'}),
+             ('apply_selection_ops', {'ops': [{'op': 'none'}, {'op': 'above', 'class_idx': 1, 'dimension': 'num_particles_total'},
+                                              {'op': 'set', 'class_idx': 1, 'selected': True}, {'op': 'threshold', 'prob_thresh': 0.3}]}),
+             ('get_class_info', {}), ('get_hist_data', {}), ('get_class_hist_data', {'class_idx': 1})]
+
+SETUP_PHASES = ('load templates', 'load particles', 'class statistics')
+OUTPUT_PHASES = ('render templates', 'write particles', 'read previews')
+
+
+def best_of(fn, repeat=3):
+  times = []
+  for _ in range(repeat):
+    tic = time.time()
+    fn()
+    times.append(time.time() - tic)
+  return min(times)
+
+
+def measure(project_dir, paths, num_classes, params, results):
+  run, rc = standins.install(project_dir, paths, params)
+  tic = time.time()
+  run.run(rc.job)
+  total = time.time() - tic
+  with open(os.path.join(project_dir, 'J2', 'single_select_metrics.json')) as f:
+    metrics = json.load(f)
+  phases = dict((p['phase'], p['wall_s']) for p in metrics['phases'])
+  record = {'run_s': total,
+            'setup_s': sum(phases.get(p, 0.0) for p in SETUP_PHASES),
+            'upload_s': phases.get('upload images', 0.0),
+            'output_s': sum(phases.get(p, 0.0) for p in OUTPUT_PHASES),
+            'phases_s': phases}
+
+  state = run.state
+  selection = run.selection
+  selected = n.arange(num_classes) % 2 == 0
+  posterior = state['particles_dset'].data['alignments2D/class_posterior']
+  record['selection_s'] = best_of(lambda: n.logical_and(selection.selection_mask(state['class_positions'], selected), posterior > 0.5))
+  record['posterior_index_s'] = best_of(lambda: selection.ClassPosteriorIndex(state['class_positions'], num_classes, posterior))
+
+  client = run.app.test_client()
+  endpoints = {}
+  endpoints_bytes = {}
+  for name, body in ENDPOINTS:
+    times = []
+    for _ in range(5):
+      tic = time.time()
+      res = client.post('/' + name, data=json.dumps(body), content_type='application/json')
+      times.append(time.time() - tic)
+      assert res.status_code == 200, '%s returned %d' % (name, res.status_code)
+    endpoints[name] = sorted(times)[len(times) // 2] * 1000.0
+    small = client.post('/' + name, data=json.dumps(body), content_type='application/json',
+                        headers={'Accept-Encoding': 'gzip', 'X-Array-Encoding': 'base64'})
+    endpoints_bytes[name] = [len(res.data), len(small.data)]
+  record['endpoints_ms'] = endpoints
+  record['endpoints_bytes'] = endpoints_bytes
+  record['peak_rss_mb'] = metrics['process_peak_rss_mb']
+  results.put(record)
+
+
+def prepare(project_dir, settings):
+  standins.make_project(project_dir, **settings)
+
+
+def git_revision():
+  try:
+    out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=standins.here, stderr=subprocess.STDOUT)
+    return out.decode('utf-8').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def load_results(path):
+  if not os.path.exists(path):
+    return []
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(record, previous, tolerance, noise_s=0.05):
+  """ names of stages slower than tolerance times the previous record """
+  slower = []
+  stages = [(k, record[k], previous.get(k)) for k in ('setup_s', 'upload_s', 'output_s', 'selection_s', 'posterior_index_s')]
+  stages += [('endpoint ' + k, v / 1000.0, previous.get('endpoints_ms', {}).get(k, 0) / 1000.0) for k, v in record['endpoints_ms'].items()]
+  for name, new, old in stages:
+    if old is not None and new > old * tolerance and new - old > noise_s:
+      slower.append('%s %.3f s -> %.3f s' % (name, old, new))
+  return slower
+
+
+def print_record(rec):
+  print('%10d particles: run %.2f s (setup %.2f, upload %.2f, output %.2f), selection %.3f s, posterior index %.3f s, peak %.0f MB' % (
+    rec['num_particles'], rec['run_s'], rec['setup_s'], rec['upload_s'], rec['output_s'], rec['selection_s'],
+    rec['posterior_index_s'], rec['peak_rss_mb']))
+  print('%10s endpoints (ms): %s' % ('', ', '.join('%s %.1f' % (name, rec['endpoints_ms'][name]) for name, _ in ENDPOINTS)))
+  print('%10s bytes (json/gzip): %s' % ('', ', '.join('%s %d/%d' % ((name,) + tuple(rec['endpoints_bytes'][name])) for name, _ in ENDPOINTS)))
+  sys.stdout.flush()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_particles', type=int, nargs='+', default=[100000, 1000000, 10000000])
+  parser.add_argument('--num_classes', type=int, default=50)
+  parser.add_argument('--box', type=int, default=128)
+  parser.add_argument('--data_dir', type=str, default='/tmp/bench_single_select', help='synthetic projects are kept here between runs')
+  parser.add_argument('--results', type=str, default='bench_single_select.jsonl')
+  parser.add_argument('--tolerance', type=float, default=1.25)
+  parser.add_argument('--check', action='store_true', help='exit with an error if any stage regressed')
+  parser.add_argument('--params', type=json.loads, default={}, help='job params as json, e.g. \'{"map_particles": false}\'')
+  args = parser.parse_args()
+
+  history = load_results(args.results)
+  regressions = []
+  for num_particles in args.num_particles:
+    settings = {'num_particles': num_particles, 'num_classes': args.num_classes, 'box': args.box}
+    project_dir = os.path.join(args.data_dir, 'N%d_K%d_B%d' % (num_particles, args.num_classes, args.box))
+    p = multiprocessing.Process(target=prepare, args=(project_dir, settings))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+      sys.exit('could not write the synthetic project in %s' % project_dir)
+    paths = {'particles': os.path.join(project_dir, 'J1', 'particles.cs'), 'templates': os.path.join(project_dir, 'J1', 'class_averages.cs')}
+    record = standins.in_subprocess(measure, project_dir, paths, args.num_classes, args.params)
+    record.update(settings)
+    record['params'] = args.params
+    record.update({'time': time.time(), 'revision': git_revision(), 'host': socket.gethostname(),
+                   'python': platform.python_version(), 'numpy': n.__version__})
+    print_record(record)
+
+    same = [r for r in history if r['host'] == record['host'] and r.get('params', {}) == args.params and all(r.get(k) == v for k, v in settings.items())]
+    if same:
+      slower = compare(record, same[-1], args.tolerance)
+      for line in slower:
+        print('%10s REGRESSION vs %s: %s' % ('', same[-1].get('revision'), line))
+      regressions += slower
+    with open(args.results, 'a') as f:
+      f.write(json.dumps(record) + '\n')
+
+  if args.check and regressions:
+    sys.exit(1)
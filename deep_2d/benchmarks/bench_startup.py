@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import standins
+
+# Startup benchmark: cold job launches against launches through the warm runner.
+#
+# Starts `warmrunner.py serve` with startup_job preloaded, then launches the same job
+# --repeat times each way, both as a fresh `python` process, the way a job starts today:
+#   cold   python startup_job.py PROJECT            (imports everything, then runs)
+#   warm   python warmrunner.py run --entry startup_job -- PROJECT
+# for an empty job (--noop: just the imports) and for single_select on a small synthetic
+# project, and reports the median launch-to-exit time and the imports each side paid for.
+#
+#   python bench_startup.py --num_particles 20000 --repeat 10
+
+WARMRUNNER = os.path.join(os.path.dirname(here), 'warmrunner.py')
+
+
+def timed(cmd, env):
+  tic = time.time()
+  out = subprocess.check_output(cmd, env=env, stderr=subprocess.STDOUT)
+  wall = time.time() - tic
+  result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+  result['wall_s'] = wall
+  return result
+
+
+def median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+
+def wait_for(path, timeout=60):
+  deadline = time.time() + timeout
+  while not os.path.exists(path):
+    if time.time() > deadline:
+      raise RuntimeError('warm runner did not start listening on %s' % path)
+    time.sleep(0.05)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_particles', type=int, default=20000)
+  parser.add_argument('--num_classes', type=int, default=10)
+  parser.add_argument('--box', type=int, default=64)
+  parser.add_argument('--data_dir', type=str, default='/tmp/bench_startup')
+  parser.add_argument('--repeat', type=int, default=10)
+  parser.add_argument('--json', type=str, default=None, help='also write the results here')
+  args = parser.parse_args()
+
+  project_dir = os.path.join(args.data_dir, 'N%d_K%d_B%d' % (args.num_particles, args.num_classes, args.box))
+  standins.make_project(project_dir, num_particles=args.num_particles, num_classes=args.num_classes, box=args.box)
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([here] + [p for p in [env.get('PYTHONPATH')] if p])
+
+  socket_path = os.path.join(tempfile.mkdtemp(prefix='bench_startup_'), 'warmrunner.sock')
+  server_log = open(os.path.join(os.path.dirname(socket_path), 'server.log'), 'w')
+  tic = time.time()
+  server = subprocess.Popen([sys.executable, WARMRUNNER, 'serve', '--socket', socket_path, '--entry', 'startup_job', '--preload', 'startup_job'],
+                            env=env, stdout=server_log, stderr=subprocess.STDOUT)
+  try:
+    wait_for(socket_path)
+    print('warm runner up in %.2f s' % (time.time() - tic))
+    results = {}
+    for name, job_args in (('noop', [project_dir, '--noop']), ('single_select', [project_dir])):
+      cold = [timed([sys.executable, os.path.join(here, 'startup_job.py')] + job_args, env) for _ in range(args.repeat)]
+      warm = [timed([sys.executable, WARMRUNNER, 'run', '--socket', socket_path, '--entry', 'startup_job', '--'] + job_args, env) for _ in range(args.repeat)]
+      results[name] = {}
+      for mode, runs in (('cold', cold), ('warm', warm)):
+        results[name][mode] = dict((k, median([r[k] for r in runs])) for k in ('wall_s', 'imports_s', 'job_s'))
+      c, w = results[name]['cold'], results[name]['warm']
+      print('%-14s cold %7.1f ms (imports %6.1f, job %6.1f)   warm %7.1f ms (imports %6.1f, job %6.1f)   %.1fx' % (
+        name, 1000 * c['wall_s'], 1000 * c['imports_s'], 1000 * c['job_s'],
+        1000 * w['wall_s'], 1000 * w['imports_s'], 1000 * w['job_s'], c['wall_s'] / w['wall_s']))
+  finally:
+    server.terminate()
+    server.wait()
+    server_log.close()
+    shutil.rmtree(os.path.dirname(socket_path))
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2)
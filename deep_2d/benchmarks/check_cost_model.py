@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+
+import numpy as n
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import planner
+
+# Fit check of the class_2D cost model in planner.py.
+#
+# Writes a synthetic project with --num_jobs completed class_2D jobs: a job.json each, as
+# cryoSPARC writes it (no box size in it), and a particles .cs whose blob/shape holds the
+# box. Runtimes come from planner's model with --coefs plus --noise relative noise. The
+# history is then read back with planner.load_history and fitted, and the script reports
+# the fitted against the generating coefficients, and how far the fitted model's runtimes
+# are from the noise-free ones. b and c trade off against each other when most jobs have
+# many classes, so the check is on the runtimes: it exits non-zero when their median error
+# is above --tolerance, or when a job is missing from the history.
+#
+#   python check_cost_model.py --num_jobs 30 --noise 0.05
+
+
+def write_job(project_path, uid, num_particles, K, box, runtime):
+  job_dir = os.path.join(project_path, uid)
+  os.makedirs(job_dir)
+  blob = n.zeros(num_particles, dtype=[('uid', '<u8'), ('blob/shape', '<u4', (2,))])
+  blob['uid'] = n.arange(num_particles)
+  blob['blob/shape'] = box
+  with open(os.path.join(job_dir, 'particles.cs'), 'wb') as fp:
+    n.save(fp, blob)
+  started = 1.5e12
+  with open(os.path.join(job_dir, 'job.json'), 'w') as fp:
+    json.dump({
+      'uid': uid, 'job_type': 'class_2D', 'status': 'completed',
+      'params_spec': {'class2D_K': {'value': K}},
+      'started_at': {'$date': started}, 'completed_at': {'$date': started + runtime * 1000.0},
+      'output_results': [{'group_name': 'particles', 'name': 'blob', 'num_items': [num_particles],
+                          'metafiles': [os.path.join(uid, 'particles.cs')]}],
+    }, fp)
+
+
+def make_history(project_path, num_jobs, coefs, noise, seed):
+  """ writes the jobs; returns their (N, K, box, runtime) records """
+  rng = n.random.RandomState(seed)
+  truth = planner.CostModel(coefs)
+  records = []
+  for i in range(num_jobs):
+    N = int(rng.randint(5000, 200000))
+    K = int(rng.randint(2, 200))
+    box = int(rng.choice([64, 128, 192, 256, 320]))
+    runtime = truth.predict(N, K, box) * (1.0 + noise * rng.randn())
+    write_job(project_path, 'J%d' % (i + 1), N, K, box, runtime)
+    records.append((N, K, box, runtime))
+  return records
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_jobs', type=int, default=30)
+  parser.add_argument('--coefs', type=float, nargs=3, default=list(planner.DEFAULT_COEFS), help='a b c of the generating model')
+  parser.add_argument('--noise', type=float, default=0.05, help='relative noise on the runtimes')
+  parser.add_argument('--tolerance', type=float, default=0.05, help='largest median relative error allowed on the fitted runtimes')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  project_path = tempfile.mkdtemp(prefix='check_cost_model_')
+  try:
+    records = make_history(project_path, args.num_jobs, args.coefs, args.noise, args.seed)
+    history = planner.load_history(project_path)
+    model = planner.CostModel().fit(history)
+  finally:
+    shutil.rmtree(project_path)
+
+  print('history: %d of %d jobs' % (len(history), len(records)))
+  print('%6s %12s %12s %10s' % ('coef', 'true', 'fitted', 'error'))
+  for name, true, fitted in zip('abc', args.coefs, model.coefs):
+    print('%6s %12.4g %12.4g %9.1f%%' % (name, true, fitted, 100.0 * abs(fitted - true) / true))
+  truth = planner.CostModel(args.coefs)
+  errors = [abs(model.predict(N, K, box) - truth.predict(N, K, box)) / truth.predict(N, K, box) for N, K, box, _ in records]
+  print('runtime error against the noise-free model: median %.1f%%, max %.1f%%' % (100.0 * n.median(errors), 100.0 * max(errors)))
+  sys.exit(1 if len(history) != len(records) or n.median(errors) > args.tolerance else 0)
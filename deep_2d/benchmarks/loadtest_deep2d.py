@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import mockmaster
+from commandclient import CommandClient
+
+# Load test of the deep2d orchestrator against the mock master.
+#
+# Starts a MockMaster in this process with a large input job J1, runs deep2d.py against
+# it in a subprocess until the whole tree is done, and reports:
+#   jobs       made, completed and failed, and the wall time of the run
+#   CPU        user+sys seconds deep2d used, in total and per job
+#   RPC        requests and calls the master served, per second and per job, and the
+#              server time per request
+#   latency    round trip of a get_job_status probe sent every --probe_interval during
+#              the run, i.e. how responsive the master stays under deep2d's load
+# followed by deep2d's own trace summary (critical path, poll lag).
+#
+# Arguments after -- go to deep2d.py and override the defaults below:
+#
+#   python loadtest_deep2d.py --num_items 2000000 --duration class_2D=2,single_select=0.2 -- --depth 3 --num_thre 5000
+
+DEEP2D_DEFAULTS = ['--num_thre', '5000', '--min_per_class', '100', '--max_k', '50', '--depth', '3',
+                   '--heartbeat', '1', '--max_heartbeat', '5', '--max_jobs', '8', '--lanes', 'default:32',
+                   '--max_select_jobs', '32', '--no_cache']
+
+
+def probe(host, port, stop, latencies, interval):
+  """ time one status call every interval until stop is set; returns through latencies, None for calls that failed """
+  cli = CommandClient(host, port, timeout=30, retries=0)
+  while not stop.wait(interval):
+    tic = time.time()
+    try:
+      cli.get_job_status('P1', 'J1')
+    except Exception:
+      latencies.append(None)
+      continue
+    latencies.append(time.time() - tic)
+
+
+def percentile(values, q):
+  if len(values) == 0:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main(argv):
+  if '--' in argv:
+    argv, deep2d_args = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+  else:
+    deep2d_args = []
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_items', type=int, default=2000000, help='particles in the input job')
+  parser.add_argument('--duration', type=str, default='class_2D=2,single_select=0.2', help='simulated job durations, as for mockmaster.py')
+  parser.add_argument('--jitter', type=float, default=0.3)
+  parser.add_argument('--failure_rate', type=float, default=0.0)
+  parser.add_argument('--lanes', type=str, default='default:32', help='simulated lane capacity, as for mockmaster.py')
+  parser.add_argument('--tick', type=float, default=0.05)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--probe_interval', type=float, default=0.5)
+  parser.add_argument('--project_path', type=str, default=None, help='default a temporary dir, removed afterwards')
+  parser.add_argument('--json', type=str, default=None, help='also write the results here')
+  args = parser.parse_args(argv)
+
+  project_path = args.project_path or tempfile.mkdtemp(prefix='loadtest_deep2d_')
+  lanes = [(lane.split(':')[0], int(lane.split(':')[1])) for lane in filter(None, args.lanes.split(','))]
+  master = mockmaster.MockMaster(project_path, mockmaster.parse_durations(args.duration), args.num_items, lanes=lanes,
+                                 jitter=args.jitter, failure_rate=args.failure_rate, seed=args.seed)
+  master.add_completed_job('J1')
+  server = mockmaster.serve(master, 'localhost', 0, args.tick)
+  host, port = server.server_address
+
+  stop = threading.Event()
+  latencies = []
+  prober = threading.Thread(target=probe, args=(host, port, stop, latencies, args.probe_interval))
+  prober.daemon = True
+  prober.start()
+
+  cmd = [sys.executable, os.path.join(os.path.dirname(here), 'deep2d.py'), '--input', 'J1', '--project_path', project_path,
+         '--master_hostname', host, '--command_port', str(port)] + DEEP2D_DEFAULTS + deep2d_args
+  log_path = os.path.join(project_path, 'deep2d.log')
+  usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+  stats_before = master.get_stats()
+  tic = time.time()
+  with open(log_path, 'w') as log:
+    returncode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+  wall = time.time() - tic
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  stop.set()
+  prober.join()
+  stats = master.get_stats()
+  server.shutdown()
+
+  cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+  num_jobs = stats['num_jobs'] - stats_before['num_jobs']
+  requests = stats['requests'] - stats_before['requests']
+  calls = dict((k, v - stats_before['calls'].get(k, 0)) for k, v in stats['calls'].items())
+  calls['get_job_status'] = calls.get('get_job_status', 0) - len(latencies) # the probe's own calls
+  requests -= len(latencies)
+  latencies = [t for t in latencies if t is not None]
+  result = {'returncode': returncode, 'wall_s': wall, 'num_jobs': num_jobs,
+            'completed': stats['completed'], 'failed': stats['failed'],
+            'deep2d_cpu_s': cpu, 'deep2d_cpu_ms_per_job': 1000.0 * cpu / max(num_jobs, 1),
+            'requests': requests, 'requests_per_s': requests / wall, 'calls': calls,
+            'calls_per_job': sum(calls.values()) / float(max(num_jobs, 1)),
+            'server_ms_per_request': 1000.0 * (stats['server_s'] - stats_before['server_s']) / max(requests, 1),
+            'probe_ms': {'p50': 1000.0 * (percentile(latencies, 0.5) or 0), 'p95': 1000.0 * (percentile(latencies, 0.95) or 0),
+                         'max': 1000.0 * max(latencies or [0])},
+            'lanes': stats['lanes'], 'deep2d_args': cmd[2:]}
+
+  print('deep2d exited %d after %.1f s: %d jobs, %d completed, %d failed' % (returncode, wall, num_jobs, result['completed'], result['failed']))
+  print('deep2d CPU     : %.1f s, %.1f ms per job' % (cpu, result['deep2d_cpu_ms_per_job']))
+  print('RPC            : %d requests, %.1f per s, %.1f calls per job, %.2f ms server time per request' % (
+    requests, result['requests_per_s'], result['calls_per_job'], result['server_ms_per_request']))
+  print('               : ' + ', '.join('%s %d' % kv for kv in sorted(calls.items())))
+  print('probe latency  : p50 %.1f ms, p95 %.1f ms, max %.1f ms' % (result['probe_ms']['p50'], result['probe_ms']['p95'], result['probe_ms']['max']))
+  for name, lane in sorted(result['lanes'].items()):
+    print('lane %-10s: peak %d running, %d queued' % (name, lane['peak_running'], lane['peak_queued']))
+  with open(log_path) as log:
+    lines = log.read().splitlines()
+  if returncode != 0:
+    print('\n'.join(lines[-20:]))
+  for i, line in enumerate(lines):
+    if line.startswith('trace:'):
+      print('\n'.join(lines[i:i + 4]))
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(result, f, indent=2)
+  if args.project_path is None:
+    shutil.rmtree(project_path)
+  return returncode
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
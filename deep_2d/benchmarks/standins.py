@@ -0,0 +1,371 @@
+import io
+import os
+import sys
+import json
+import types
+import struct
+import importlib
+import multiprocessing
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import numpy as n
+
+# Local stand-ins for the parts of cryoSPARC that single_select runs against, so the job
+# can be run and timed without a cryoSPARC install:
+#
+#   Dataset           a structured array with uid first, and the few methods the job uses
+#   runcommon         inputs loaded from .cs files in a project dir, outputs and logs recorded
+#   blobio.mrc        read_mrc for the MRC files written here
+#   plotutil          the two plots the job draws, drawn with plain matplotlib
+#   jobregister / buildcommon   just enough to import the job package
+#
+# install() puts them under a fake cryosparc_compute package in sys.modules, with the
+# repo's deep_2d directory as cryosparc_compute.jobs, and imports the real
+# single_select.run from it:
+#
+#   paths = make_project('/tmp/bench', num_particles=1000000, num_classes=50, box=128)
+#   run, rc = install('/tmp/bench', paths, params={'particle_count_above': 10000})
+#   run.run(rc.job)
+#
+# in_subprocess() runs one measurement in a fresh process, for the benchmarks here.
+
+here = os.path.dirname(os.path.abspath(__file__))
+jobs_dir = os.path.dirname(here)
+
+
+class Dataset(object):
+  """ just enough of the cryoSPARC Dataset: a structured array with uid first """
+
+  def __init__(self, data):
+    self.data = data
+
+  def __len__(self):
+    return len(self.data)
+
+  def fields(self):
+    return list(self.data.dtype.names)
+
+  def subset_idxs(self, idxs):
+    return Dataset(self.data[idxs])
+
+  def filter_prefixes(self, prefixes):
+    names = [f for f in self.data.dtype.names if f == 'uid' or f.split('/')[0] in prefixes]
+    out = n.empty(len(self.data), dtype=[(f, self.data.dtype[f]) for f in names])
+    for f in names:
+      out[f] = self.data[f]
+    return Dataset(out)
+
+  def filter_prefix(self, prefix):
+    return self.filter_prefixes([prefix])
+
+  def to_file(self, path):
+    with open(path, 'wb') as f:
+      n.save(f, self.data)
+
+  @classmethod
+  def load(cls, path):
+    return cls(n.load(path))
+
+
+# ---- data ------------------------------------------------------------------
+
+def write_mrc(path, stack):
+  """ float32 (nz, ny, nx) stack as an MRC file with a bare header """
+  stack = n.asarray(stack, dtype='<f4')
+  header = bytearray(1024)
+  header[0:16] = struct.pack('<4i', stack.shape[2], stack.shape[1], stack.shape[0], 2)
+  header[208:212] = b'MAP '
+  with open(path, 'wb') as f:
+    f.write(bytes(header))
+    f.write(stack.tobytes())
+
+
+def read_mrc(path):
+  with open(path, 'rb') as f:
+    header = f.read(1024)
+    nx, ny, nz, mode = struct.unpack('<4i', header[0:16])
+    nsymbt, = struct.unpack('<i', header[92:96])
+    f.seek(1024 + nsymbt)
+    data = n.fromfile(f, dtype='<f4', count=nx * ny * nz).reshape(nz, ny, nx)
+  return {'nx': nx, 'ny': ny, 'nz': nz, 'mode': mode}, data
+
+
+def make_images(num, box, rng):
+  """ noisy gaussian blobs of different widths and offsets """
+  y, x = n.mgrid[0:box, 0:box].astype(n.float32) - box / 2.0
+  out = n.empty((num, box, box), dtype=n.float32)
+  for i in range(num):
+    cy, cx = rng.uniform(-box / 8.0, box / 8.0, 2)
+    sigma = rng.uniform(box / 16.0, box / 6.0)
+    out[i] = n.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * sigma ** 2)) + 0.2 * rng.randn(box, box)
+  return out
+
+
+def make_particles(num_particles, num_classes=50, paths=('J1/extract/particles_000.mrc',), images_per_file=1000, seed=0):
+  """ particles spread unevenly over num_classes, with blob rows cycling through the given MRC files """
+  rng = n.random.RandomState(seed)
+  path_len = max(len(p) for p in paths)
+  dtype = [('uid', '<u8'),
+           ('blob/path', 'S%d' % path_len), ('blob/idx', '<u4'), ('blob/shape', '<u4', (2,)), ('blob/psize_A', '<f4'),
+           ('alignments2D/class', '<u4'), ('alignments2D/class_posterior', '<f4'), ('alignments2D/class_ess', '<f4'),
+           ('alignments2D/pose', '<f4'), ('alignments2D/shift', '<f4', (2,)),
+           ('ctf/df1_A', '<f4'), ('ctf/df2_A', '<f4'), ('location/center_x_frac', '<f4')]
+  data = n.zeros(num_particles, dtype=dtype)
+  data['uid'] = rng.randint(0, 2**62, num_particles).astype('<u8')
+  rows = n.arange(num_particles)
+  data['blob/path'] = n.array([p.encode('utf-8') for p in paths])[(rows // images_per_file) % len(paths)]
+  data['blob/idx'] = rows % images_per_file
+  data['blob/psize_A'] = 1.1
+  weights = rng.dirichlet(n.ones(num_classes) * 0.5)
+  data['alignments2D/class'] = rng.choice(num_classes, num_particles, p=weights)
+  data['alignments2D/class_posterior'] = rng.beta(5, 1, num_particles)
+  data['alignments2D/class_ess'] = rng.uniform(1, 3, num_particles)
+  data['alignments2D/pose'] = rng.uniform(0, 2 * n.pi, num_particles)
+  return Dataset(data)
+
+
+def make_templates(num_classes, path='J1/class_averages.mrc', seed=0):
+  rng = n.random.RandomState(seed)
+  data = n.zeros(num_classes, dtype=[('uid', '<u8'), ('blob/path', 'S%d' % len(path)), ('blob/idx', '<u4'),
+                                     ('blob/shape', '<u4', (2,)), ('blob/psize_A', '<f4'), ('blob/res_A', '<f4')])
+  data['uid'] = rng.randint(0, 2**62, num_classes).astype('<u8')
+  data['blob/path'] = path.encode('utf-8')
+  data['blob/idx'] = n.arange(num_classes)
+  data['blob/psize_A'] = 1.1
+  data['blob/res_A'] = rng.uniform(5, 30, num_classes)
+  return Dataset(data)
+
+
+def make_project(project_dir, num_particles, num_classes=50, box=128, num_particle_files=4, images_per_file=1000, seed=0):
+  """ write a synthetic class_2D job J1 into project_dir; reused when one with the same settings is there.
+  Returns {input group name: path of its .cs file}. """
+  settings = {'num_particles': num_particles, 'num_classes': num_classes, 'box': box,
+              'num_particle_files': num_particle_files, 'images_per_file': images_per_file, 'seed': seed}
+  job_dir = os.path.join(project_dir, 'J1')
+  paths = {'particles': os.path.join(job_dir, 'particles.cs'), 'templates': os.path.join(job_dir, 'class_averages.cs')}
+  manifest = os.path.join(job_dir, 'synthetic.json')
+  if os.path.exists(manifest):
+    with open(manifest) as f:
+      if json.load(f) == settings:
+        return paths
+  if not os.path.isdir(os.path.join(job_dir, 'extract')):
+    os.makedirs(os.path.join(job_dir, 'extract'))
+  rng = n.random.RandomState(seed)
+  write_mrc(os.path.join(job_dir, 'class_averages.mrc'), make_images(num_classes, box, rng))
+  particle_paths = ['J1/extract/particles_%03d.mrc' % i for i in range(num_particle_files)]
+  for path in particle_paths:
+    write_mrc(os.path.join(project_dir, path), make_images(images_per_file, box, rng))
+  make_templates(num_classes, 'J1/class_averages.mrc', seed).to_file(paths['templates'])
+  make_particles(num_particles, num_classes, particle_paths, images_per_file, seed).to_file(paths['particles'])
+  with open(manifest, 'w') as f:
+    json.dump(settings, f)
+  return paths
+
+
+# ---- cryoSPARC modules -----------------------------------------------------
+
+class Recorder(object):
+  """ any method call is recorded and returns None, like a command client nobody answers """
+
+  def __init__(self):
+    self.calls = []
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    def call(*args, **kwargs):
+      self.calls.append((name, args, kwargs))
+    return call
+
+
+def _png(fig):
+  buf = io.BytesIO()
+  fig.savefig(buf, format='png')
+  return buf.getvalue()
+
+
+def make_plotutil():
+  mod = types.ModuleType('cryosparc_compute.plotutil')
+
+  def plot_2D_classes_return_images(stack):
+    from matplotlib import image
+    out = []
+    for img in stack:
+      buf = io.BytesIO()
+      image.imsave(buf, img, cmap='gray', format='png')
+      buf.seek(0)
+      out.append(buf)
+    return out
+
+  def plot_images_simple(images, rows=3, cols=3, radwn=6, figscale=0.6):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(cols * figscale * 2, rows * figscale * 2))
+    FigureCanvasAgg(fig)
+    for i, img in enumerate(images[:rows * cols]):
+      ax = fig.add_subplot(rows, cols, i + 1)
+      ax.imshow(img, cmap='gray')
+      ax.axis('off')
+    return fig
+
+  mod.plot_2D_classes_return_images = plot_2D_classes_return_images
+  mod.plot_images_simple = plot_images_simple
+  return mod
+
+
+INPUT_SLOTS = {'particles': ['blob', 'alignments2D'], 'templates': ['blob']}
+
+
+def make_runcommon(project_dir, input_paths, params, verbose=False):
+  mod = types.ModuleType('cryosparc_compute.jobs.runcommon')
+  # every input group comes from J1, each slot from its group's .cs file
+  mod.job = {'project_uid': 'P1', 'uid': 'J2', 'job_dir': 'J2', 'params': params,
+             'input_slot_groups': [{'name': group, 'connections': [{'job_uid': 'J1', 'group_name': group, 'slots': [
+               {'slot_name': slot, 'job_uid': 'J1', 'group_name': group, 'result_name': slot, 'version': 'F'}
+               for slot in INPUT_SLOTS[group]]}]} for group in input_paths]}
+  parent = {'uid': 'J1', 'output_results': [{'group_name': group, 'name': slot, 'versions': [0],
+                                             'metafiles': [os.path.relpath(path, project_dir)]}
+                                            for group, path in input_paths.items() for slot in INPUT_SLOTS[group]]}
+  mod.cli = Recorder()
+  mod.cli.get_job = lambda project_uid, job_uid, *fields: parent
+  mod.logs = []
+  mod.outputs = []
+  mod.images = {}
+  mod.uploads = []
+  job_dir_abs = os.path.join(project_dir, 'J2')
+  if not os.path.isdir(job_dir_abs):
+    os.makedirs(job_dir_abs)
+
+  class com(object):
+    @staticmethod
+    def get_merged_params(job):
+      return dict(job['params'])
+
+    @staticmethod
+    def is_input_slot_connected(job, group_name, slot_name):
+      return group_name in input_paths
+
+  def log(msg, *args, **kwargs):
+    mod.logs.append(str(msg))
+    if verbose:
+      print(msg)
+
+  def load_input_group(input_group_name, slot_names):
+    dset = Dataset.load(input_paths[input_group_name])
+    return dset.filter_prefixes(slot_names)
+
+  def output(group_name, slot_name, path_rel, start, count):
+    mod.outputs.append((group_name, slot_name, path_rel, int(start), int(count)))
+
+  def upload_file(fileobj, filename=None):
+    mod.uploads.append(filename)
+    return 'file%d' % len(mod.uploads)
+
+  def log_plot(fig, text, *args, **kwargs):
+    mod.images['log %d' % len(mod.images)] = _png(fig)
+
+  def set_output_group_image(group_name, fig):
+    mod.images[group_name] = _png(fig)
+
+  def set_tile_image(group_name, fig, *args):
+    mod.images['tile ' + group_name] = _png(fig)
+
+  mod.com = com
+  mod.log = log
+  mod.get_project_dir_abs = lambda: project_dir
+  mod.load_input_group = load_input_group
+  mod.output = output
+  mod.upload_file = upload_file
+  mod.log_plot = log_plot
+  mod.set_output_group_image = set_output_group_image
+  mod.set_tile_image = set_tile_image
+  return mod
+
+
+class _BuildJob(dict):
+  """ records the params a builder declares, so the stand-in job gets every default """
+
+  def __init__(self):
+    dict.__init__(self)
+    self.defaults = {}
+
+  def param_add(self, section, name, base_value=None, **kwargs):
+    self.defaults[name] = base_value
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return lambda *args, **kwargs: None
+
+
+def _package(name, path=None):
+  mod = types.ModuleType(name)
+  mod.__path__ = [path] if path else []
+  sys.modules[name] = mod
+  parent, _, child = name.rpartition('.')
+  if parent:
+    setattr(sys.modules[parent], child, mod)
+  return mod
+
+
+def _module(name, mod):
+  sys.modules[name] = mod
+  parent, _, child = name.rpartition('.')
+  setattr(sys.modules[parent], child, mod)
+  return mod
+
+
+def install(project_dir, input_paths, params=None, verbose=False, serve=None):
+  """ import single_select.run against the stand-ins. Returns (run module, runcommon stand-in);
+  the job doc to pass to run.run is runcommon.job. Call once per process.
+  An interactive run calls serve(app) instead of starting the web server; by default it
+  returns at once, as if the selection was finished right away. """
+  _package('cryosparc_compute')
+  _package('cryosparc_compute.jobs', jobs_dir)
+  _package('cryosparc_compute.blobio')
+  mrc = types.ModuleType('cryosparc_compute.blobio.mrc')
+  mrc.read_mrc = read_mrc
+  _module('cryosparc_compute.blobio.mrc', mrc)
+  _module('cryosparc_compute.plotutil', make_plotutil())
+
+  jobregister = types.ModuleType('cryosparc_compute.jobs.jobregister')
+  jobregister.register = lambda **kwargs: None
+  _module('cryosparc_compute.jobs.jobregister', jobregister)
+  buildcommon = types.ModuleType('cryosparc_compute.jobs.buildcommon')
+  buildcommon.builderbase = object
+  buildcommon.com = None
+  _module('cryosparc_compute.jobs.buildcommon', buildcommon)
+
+  build = importlib.import_module('cryosparc_compute.jobs.single_select.build')
+  build_job = _BuildJob()
+  # builder methods take the job as their only argument; call the plain function on py2 and 3 alike
+  build.builder.__dict__['initialize_params_and_inputs'](build_job)
+  all_params = dict(build_job.defaults)
+  all_params.update(params or {})
+
+  rc = _module('cryosparc_compute.jobs.runcommon', make_runcommon(project_dir, input_paths, all_params, verbose))
+  run = importlib.import_module('cryosparc_compute.jobs.single_select.run')
+  run.app.run = lambda *args, **kwargs: serve(run.app) if serve else None
+  return run, rc
+
+
+# ---- benchmark processes ---------------------------------------------------
+
+def in_subprocess(target, *args):
+  """ target(*args, results) in a fresh process; returns what it put on results. Raises if the
+  process exited without putting anything there, instead of waiting for it forever. """
+  results = multiprocessing.Queue()
+  p = multiprocessing.Process(target=target, args=args + (results,))
+  p.start()
+  try:
+    while True:
+      try:
+        return results.get(timeout=1.0)
+      except queue.Empty:
+        if not p.is_alive() and results.empty():
+          raise RuntimeError('%s exited with code %s without a result' % (target.__name__, p.exitcode))
+  finally:
+    p.join()
@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+
+tic = time.time()
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+import numpy
+import flask
+import matplotlib.figure
+import matplotlib.backends.backend_agg
+
+import standins
+
+# A single_select job as bench_startup.py launches it, cold or through the warm runner.
+# Importing this module pulls in what single_select.run needs (numpy, flask, matplotlib
+# and the stand-ins); running it as __main__ runs the job on a synthetic project:
+#
+#   python startup_job.py /tmp/bench_startup/N20000_K10_B64          the job
+#   python startup_job.py /tmp/bench_startup/N20000_K10_B64 --noop   imports only
+#
+# The last line printed is the seconds spent in this module's imports, as json.
+
+imports_s = time.time() - tic
+
+
+def main(argv):
+  project_dir = argv[0]
+  tic = time.time()
+  if '--noop' not in argv:
+    paths = {'particles': os.path.join(project_dir, 'J1', 'particles.cs'), 'templates': os.path.join(project_dir, 'J1', 'class_averages.cs')}
+    run, rc = standins.install(project_dir, paths)
+    run.run(rc.job)
+  print('{"imports_s": %f, "job_s": %f}' % (imports_s, time.time() - tic))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
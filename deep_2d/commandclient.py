@@ -0,0 +1,136 @@
+import json
+import time
+import socket
+import threading
+import itertools
+
+try:
+  import httplib
+except ImportError:
+  import http.client as httplib
+
+# Persistent JSON-RPC client for the cryoSPARC command server.
+#
+# `cryosparcm cli '...'` starts a new python interpreter and a new connection for
+# every call. This client keeps one HTTP/1.1 keep-alive connection per thread and
+# reuses it for every call, with a per-call timeout and retries on connection errors.
+# Only queries (get_*) are retried once the request went out: a make_job or enqueue_job
+# that timed out may well have run on the server, and sending it again would make or
+# queue the job twice. Those fail instead, and deep2d --resume picks up from the journal.
+#
+#   cli = CommandClient('localhost', 39002)
+#   cli.get_job_status('P1', 'J12')
+#   cli.make_job('class_2D', 'P1', 'W2', '', None, None, {...}, {...})
+#   cli.batch([('get_job_status', ('P1', 'J12')), ('get_job_status', ('P1', 'J13'))])
+
+
+class CommandError(Exception):
+  """ The command server answered the call with a JSON-RPC error. Never retried. """
+  pass
+
+
+def is_idempotent(method):
+  """ calls that can be sent again after a timeout without changing anything on the server """
+  return method.startswith('get_')
+
+
+class CommandClient(object):
+
+  def __init__(self, host='localhost', port=39002, url='/api', timeout=300, retries=3, retry_delay=1.0):
+    self.host = host
+    self.port = int(port)
+    self.url = url
+    self.timeout = timeout
+    self.retries = retries
+    self.retry_delay = retry_delay
+    self._local = threading.local()
+    self._ids = itertools.count()
+    self._ids_lock = threading.Lock()
+    self.num_calls = 0
+    self.batch_supported = True
+
+  def __getattr__(self, key):
+    if key.startswith('_'):
+      raise AttributeError(key)
+    def func(*args, **kwargs):
+      return self.call(key, *args, **kwargs)
+    func.__name__ = key
+    return func
+
+  def _next_id(self):
+    with self._ids_lock:
+      self.num_calls += 1
+      return next(self._ids)
+
+  def _connection(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+      self._local.conn = conn
+    return conn
+
+  def _reset(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is not None:
+      conn.close()
+    self._local.conn = None
+
+  def _post(self, payload, idempotent=True):
+    """ POST one JSON body on this thread's connection, reconnecting and retrying on connection errors.
+    A call that isn't idempotent is only retried if it failed before the request was sent. """
+    body = json.dumps(payload)
+    headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+    attempt = 0
+    while True:
+      sent = False
+      try:
+        conn = self._connection()
+        conn.request('POST', self.url, body, headers)
+        sent = True
+        resp = conn.getresponse()
+        data = resp.read()
+        if resp.status != 200:
+          raise httplib.HTTPException('command server returned HTTP %d' % resp.status)
+        return json.loads(data)
+      except (socket.error, socket.timeout, httplib.HTTPException, ValueError) as e:
+        self._reset()
+        attempt += 1
+        if attempt > self.retries or (sent and not idempotent):
+          raise
+        print('Command server call failed (%s), retry %d/%d' % (e, attempt, self.retries))
+        time.sleep(self.retry_delay * attempt)
+
+  def call(self, method, *args, **kwargs):
+    params = kwargs if len(kwargs) else list(args)
+    res = self._post({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': self._next_id()}, is_idempotent(method))
+    if res.get('error') is not None:
+      raise CommandError('%s: %s' % (method, res['error']))
+    return res.get('result')
+
+  def batch(self, calls):
+    """ Make several calls in one round trip as a JSON-RPC 2.0 batch.
+    calls is a list of (method, args) tuples. Returns a list with one entry per call, in order:
+    the result, or a CommandError instance if that call failed. A server that answers a batch with
+    anything but a list does not accept batches; it is then served one call at a time on the same
+    connection. Connection and HTTP errors are raised as for call(), and leave batching on. """
+    if len(calls) == 0:
+      return []
+    if self.batch_supported:
+      payload = [{'jsonrpc': '2.0', 'method': method, 'params': list(args), 'id': self._next_id()} for method, args in calls]
+      res = self._post(payload, all(is_idempotent(method) for method, _ in calls))
+      if isinstance(res, list):
+        by_id = dict((r.get('id'), r) for r in res)
+        out = []
+        for req, (method, _) in zip(payload, calls):
+          r = by_id.get(req['id'], {'error': 'no response'})
+          out.append(CommandError('%s: %s' % (method, r['error'])) if r.get('error') is not None else r.get('result'))
+        return out
+      print('Command server does not accept batched calls, falling back to one call at a time')
+      self.batch_supported = False
+    out = []
+    for method, args in calls:
+      try:
+        out.append(self.call(method, *args))
+      except CommandError as e:
+        out.append(e)
+    return out
@@ -1,14 +1,16 @@
 import os
 import sys
-import time
-import thread
 import json
-import subprocess
-
-sys.path.append('/cryoprograms/cryosparc/cryosparc2_master/')
-from cryosparc2_compute.client import CommandClient
+import time
 
-cli = CommandClient('syg2', 39002)
+from commandclient import CommandClient, CommandError
+from jobwatcher import JobWatcher
+from scheduler import Scheduler
+import planner
+from journal import Journal
+from jobcache import JobCache
+from admission import AdmissionController, parse_lanes
+from jobtrace import JobTrace, print_summary
 
 import argparse
 parser=argparse.ArgumentParser()
@@ -19,99 +21,309 @@ parser.add_argument('--mode',type=str,default='child')
 parser.add_argument('--k',type=int,default=5)
 parser.add_argument('--num_thre',type=int,default=100000)
 parser.add_argument('--heartbeat',type=int,default=10)
-parser.add_argument('--depth',type=int,default=2)
+parser.add_argument('--max_heartbeat',type=int,default=120)
+parser.add_argument('--depth',type=int,default=2,help='levels of class_2D to run, counting the first')
+parser.add_argument('--max_jobs',type=int,default=4,help='subtrees classified at the same time')
+parser.add_argument('--tree_out',type=str,default=None,help='write the job tree as json here')
+parser.add_argument('--journal',type=str,default=None,help='job journal file, default deep2d_<input>.journal in the project dir')
+parser.add_argument('--resume',action='store_true',help='replay the journal: reuse finished jobs, reattach to running ones, submit only what is missing. Without it an existing journal is an error')
+parser.add_argument('--no_cache',action='store_true',help='always queue new jobs, never reuse a completed job with the same inputs and params')
+parser.add_argument('--cache_max_age_days',type=float,default=30)
+parser.add_argument('--trace_out',type=str,default=None,help='write a Chrome trace (chrome://tracing, ui.perfetto.dev) of every job here')
+parser.add_argument('--dry_run','--dry-run',action='store_true',help='print the predicted job tree, GPU hours and wall time, queue nothing')
+parser.add_argument('--box_size',type=int,default=256,help='particle box size of this run, for the cost model')
+parser.add_argument('--max_k',type=int,default=200)
+parser.add_argument('--min_per_class',type=int,default=1000,help='never pick more classes than this many particles each')
+parser.add_argument('--max_class2d_hours',type=float,default=12.0,help='lower K until the cost model predicts one class_2D fits in this many hours, 0 for no limit')
+parser.add_argument('--class_decay',type=float,default=0.5,help='assumed class size fall-off, for --dry_run')
+parser.add_argument('--split_select',action='store_true',help='one single_select job writes every class instead of one job per class')
+parser.add_argument('--lanes',type=str,default='default:8',help='lanes to queue on and how many jobs this run keeps queued or running on each, e.g. default:4,gpu2:2')
+parser.add_argument('--select_lane',type=str,default=None,help='lane for single_select jobs, default the first of --lanes')
+parser.add_argument('--max_select_jobs',type=int,default=4,help='single_select jobs queued or running at once')
 parser.add_argument('--project_path',type=str,default='/data/20201123_Congye_P3L/P1/')
+parser.add_argument('--master_hostname',type=str,default='syg2')
+parser.add_argument('--command_port',type=int,default=39002)
+parser.add_argument('--rpc_timeout',type=float,default=60)
+parser.add_argument('--rpc_retries',type=int,default=3)
 args=parser.parse_args()
 
+# one long lived client for every call to the command server
+cli = CommandClient(args.master_hostname, args.command_port, timeout=args.rpc_timeout, retries=args.rpc_retries)
+# and one watcher that polls the status of every outstanding job in a single batched call
+watcher = JobWatcher(cli, args.pid, min_interval=args.heartbeat, max_interval=args.max_heartbeat)
+watcher.start()
+
 
 num_thre=args.num_thre
-def check_state():
+sched=Scheduler(args.max_jobs)
+# class_2D cost model fitted to the finished class_2D jobs of this project
+model=planner.CostModel().fit(planner.load_history(args.project_path))
+print('cost model from %d past class_2D jobs' % model.num_records)
+
+submitted={} # job uid -> (job_type, params, inputs) of the jobs this run made
+
+def choose_k(num_particles):
+  return planner.choose_k(num_particles,num_thre,model,args.box_size,args.max_k,args.min_per_class,args.max_class2d_hours)
+
+def check_state(jid):
   try:
-    state=os.popen('cryosparcm cli \' get_job_status("'+args.pid+'","'+args.input+'")  \'').read().split('\n')[0]
-    if len(state)>3: 
+    state=cli.get_job_status(args.pid,jid)
+    if state and len(state)>3: 
       return state
     else:
-      print state
+      print(state)
       return 'error'
   except:
     return 'error'
 
 
-def get_particles():
+def get_particles(job_doc,group_name=None):
+  # bare job uids count the first output, like the inputs deep2d was always started on
   try:
-    return int(j['output_results'][0]['num_items'][0])
+    if group_name is None:
+      return int(job_doc['output_results'][0]['num_items'][0])
+    for result in job_doc['output_results']:
+      if result.get('group_name')==group_name:
+        return int(result['num_items'][0])
+    return 0
   except:
     return 0
 
+def load_job_json(jid):
+  fp=open(args.project_path+'/'+jid+'/job.json')
+  job_doc=json.load(fp)
+  fp.close()
+  return job_doc
+
+def enqueue(key,jid,job_type,lane=None):
+  # queue on the lane of a slot from admission control, waiting for one unless the caller holds it already
+  if lane is None:
+    lane=admission.acquire(job_type)
+  try:
+    cli.enqueue_job(args.pid,jid,lane)
+  except:
+    admission.cancel(lane,job_type)
+    raise
+  trace.mark(jid,'enqueued',lane=lane)
+  admission.admitted(lane,jid,job_type)
+  journal.record('enqueued',key,jid,lane=lane)
+
+def submit_job(key,job_type,params,inputs,**extra):
+  # make and enqueue a job, or reattach to the one the journal already has for this key
+  entry=journal.lookup(key)
+  if entry is not None:
+    new_jobid=entry['job_uid']
+    if entry['state']=='created':
+      enqueue(key,new_jobid,job_type)
+    elif entry['state']=='enqueued':
+      admission.adopt(entry.get('lane'),new_jobid,job_type)
+    print('resumed '+key+': '+new_jobid+' '+entry['state'])
+    return new_jobid
+  if cache is not None:
+    cached_jobid=cache.lookup(job_type,params,inputs)
+    if cached_jobid is not None:
+      print('reused '+job_type+' '+cached_jobid+' for '+key)
+      journal.record('completed',key,cached_jobid,cached=True,**extra)
+      return cached_jobid
+  # the slot is taken before the job is made, so a full lane holds back making jobs too
+  requested=time.time()
+  lane=admission.acquire(job_type)
+  try:
+    new_jobid=cli.make_job(job_type,args.pid,args.wid,"",None,None,params,inputs)
+    trace.mark(new_jobid,'created',t=requested,job_type=job_type,key=key,inputs=sorted(set(r.split('.')[0] for r in inputs.values())))
+    submitted[new_jobid]=(job_type,params,inputs)
+    journal.record('created',key,new_jobid,**extra)
+  except:
+    admission.cancel(lane,job_type)
+    raise
+  enqueue(key,new_jobid,job_type,lane)
+  return new_jobid
+
+def record_state(key,jid,state):
+  if state=='completed':
+    journal.record('completed',key,jid)
+    if cache is not None and jid in submitted:
+      cache.store(*(submitted[jid]+(jid,)))
+  else:
+    journal.record('failed',key,jid,status=state)
+
+def wait_completed(jid,key=None):
+  state=watcher.wait(jid)
+  if key is not None:
+    record_state(key,jid,state)
+  if state!='completed':
+    raise RuntimeError('Job '+jid+' '+state)
+
 #2d 
-def queue_class2d(jid,knum):
-  new_jobid=os.popen('cryosparcm cli \'make_job ("class_2D","'+args.pid+'","'+args.wid+'","",None,None,{"compute_use_ssd":"False","class2D_K":"'+str(knum)+'"},{"particles":"'+jid+'.particles_selected"})\'').read().split('\n')[0]
-  #sub_pro=subprocess.
-  os.system('cryosparcm cli \' enqueue_job("'+args.pid+'","'+new_jobid+'","default")   \'')
-  state=''
-  while(state!='completed'):
-    time.sleep(args.heartbeat*6)
-    state=os.popen('cryosparcm cli \' get_job_status("'+args.pid+'","'+new_jobid+'")  \'').read().split('\n')[0]
-  #sub_pro.communicate()
+def queue_class2d(particles_ref,knum):
+  key='class_2D '+particles_ref
+  new_jobid=submit_job(key,"class_2D",{"compute_use_ssd":"False","class2D_K":str(knum)},{"particles":particles_ref},K=knum)
+  print('class_2D '+new_jobid+' queued on '+particles_ref+' with K='+str(knum))
+  wait_completed(new_jobid,key)
   return new_jobid
 
-def queue_select2d(djid,idx):
-  
-  new_jobid=os.popen('cryosparcm cli \'make_job ("single_select","'+args.pid+'","'+args.wid+'","",None,None,{"class_idx":"'+str(idx)+'","particle_count_above":"'+str(num_thre)+'"},{"particles":"'+djid+'.particles","templates":"'+djid+'.class_averages"})\'').read().split('\n')[0]
-  os.popen('cryosparcm cli \' enqueue_job("'+args.pid+'","'+new_jobid+'","default")   \'')
-  os.system('sh ~/bin/run.sh '+new_jobid)
-  print('sh ~/bin/kongfang_packages/run.sh '+new_jobid)
-  waiting_list.pop() 
-  return 
+def queue_select2d(djid,knum):
+  # one single_select job per class, queued as fast as admission control lets them; returns [(particles ref, count)] of the selected subsets
+  jobids=[]
+  keys=[]
+  for idx in range(knum):
+    keys.append('single_select '+djid+' '+str(idx))
+    new_jobid=submit_job(keys[-1],"single_select",{"class_idx":str(idx),"particle_count_above":str(num_thre)},{"particles":djid+".particles","templates":djid+".class_averages"})
+    jobids.append(new_jobid)
+  futures=[watcher.watch(jid) for jid in jobids]
+  subsets=[]
+  for key,jid,fut in zip(keys,jobids,futures):
+    record_state(key,jid,fut.result())
+    if fut.state!='completed':
+      print('Job '+jid+' '+fut.state+', skipped.')
+      continue
+    subsets.append((jid+'.particles_selected',get_particles(load_job_json(jid),'particles_selected')))
+  return jobids,subsets
 
+def queue_split_select2d(djid,knum):
+  # one single_select job reads the class_2D output once and writes particles_selected_<k> for every class
+  key='split_select '+djid
+  new_jobid=submit_job(key,"single_select",{"split_class_idxs":"all","split_num_classes":str(knum),"particle_count_above":str(num_thre)},{"particles":djid+".particles","templates":djid+".class_averages"})
+  wait_completed(new_jobid,key)
+  split_job=load_job_json(new_jobid)
+  subsets=[]
+  for result in split_job['output_results']:
+    group_name=result.get('group_name','')
+    ref=new_jobid+'.'+group_name
+    if group_name.startswith('particles_selected_') and ref not in [r for r,_ in subsets]:
+      # every class is declared, but classes the job skipped come back without num_items
+      count=get_particles(split_job,group_name)
+      if count>0:
+        subsets.append((ref,count))
+  return [new_jobid],subsets
 
+def new_node(particles_ref,level):
+  return {'input':particles_ref,'level':level,'num_particles':None,'K':None,'class_2D':None,'single_select':[],'children':[],'status':'pending'}
 
-waiting_list=[]
-K=args.k
-j={}
-if args.mode=='child':
-  print('one job come in :'+args.input)
-#checkfirst
-  input_job=args.input.split('.')[0]
-  while(check_state()!='completed'):
-    print('Queued beacause Current Inputs are not avaliable.') 
-    print('Job '+args.input+' status: '+check_state())
-  # status like killed may throw exception
-    time.sleep(args.heartbeat)
-  
-  fp=open(args.project_path+'/'+args.input+'/job.json')
-  j=json.load(fp)
-  fp.close() 
-  fp=0
-
-# check particle number
-  if get_particles()<=num_thre:
-    print('Too few particles,stop now.')
-    sys.exit(1)
+def run_node(node,class2d_jid=None):
+  """ classify one particle subset, select its classes, and submit every big enough class as a subtree """
+  if class2d_jid is None:
+    input_job=node['input'].split('.')[0]
+    input_group=node['input'].split('.')[1] if '.' in node['input'] else None
+    if check_state(input_job)!='completed':
+      print('Queued beacause Current Inputs are not avaliable: '+node['input'])
+      wait_completed(input_job)
+    node['num_particles']=get_particles(load_job_json(input_job),input_group)
+    if node['num_particles']<=num_thre:
+      node['status']='too few particles'
+      return
+    # determin K number according to particles number, unless a resumed run already picked it
+    particles_ref=input_job+'.'+(input_group or 'particles_selected')
+    entry=journal.lookup('class_2D '+particles_ref)
+    node['K']=entry['K'] if entry is not None else choose_k(node['num_particles'])
+    node['status']='class_2D'
+    class2d_jid=queue_class2d(particles_ref,node['K'])
   else:
-  # determin K number according to particles number
-    K=get_particles()*4/args.num_thre
-    print(K)
-    #print(get_particles())
-    JID=queue_class2d(args.input,K)
+    node['K']=args.k
+  node['class_2D']=class2d_jid
+  node['status']='single_select'
+  if args.split_select:
+    node['single_select'],subsets=queue_split_select2d(class2d_jid,node['K'])
+  else:
+    node['single_select'],subsets=queue_select2d(class2d_jid,node['K'])
+  node['status']='done'
+  if node['level']>=args.depth:
+    return
+  for ref,count in subsets:
+    if count>num_thre:
+      child=new_node(ref,node['level']+1)
+      child['num_particles']=count
+      node['children'].append(child)
+      sched.submit(run_node,child,task_name='deep2d '+ref)
+
+def print_tree(node,indent=''):
+  line=indent+node['input']+' ('+str(node['num_particles'])+' particles) '
+  if node['class_2D']:
+    line+='class_2D '+node['class_2D']+' K='+str(node['K'])+', single_select '+','.join(node['single_select'])
+  else:
+    line+=node['status']
+  print(line)
+  for child in node['children']:
+    print_tree(child,indent+'  ')
+
+
+if len(args.input.split('.')[0].split('J'))!=2:
+  print('Error Job got!'+args.input)
+  sys.exit(1)
+
+print('one job come in :'+args.input)
+root=new_node(args.input,1)
+
+if args.dry_run:
+  input_job=args.input.split('.')[0]
+  input_group=args.input.split('.')[1] if '.' in args.input else ('particles' if args.mode!='child' else None)
+  num_particles=get_particles(load_job_json(input_job),input_group)
+  # outside child mode the input is a finished class_2D with --k classes, and only its selection runs
+  plan=planner.plan_tree(num_particles,num_thre,model,args.box_size,args.depth,class_decay=args.class_decay,
+                         given_k=args.k if args.mode!='child' else None,
+                         max_k=args.max_k,min_per_class=args.min_per_class,max_hours=args.max_class2d_hours)
+  planner.print_plan(plan)
+  num_jobs,gpu_hours,wall_hours=planner.summarize(plan,args.max_jobs)
+  print('%d class_2D jobs, %.1f GPU hours, about %.1f hours wall time' % (num_jobs,gpu_hours,wall_hours))
+  watcher.stop()
+  sys.exit(0)
+
+lanes=parse_lanes(args.lanes)
+try:
+  known_lanes=[lane['name'] for lane in cli.get_scheduler_lanes()]
+  for name,_ in lanes:
+    if name not in known_lanes:
+      print('Unknown lane '+name+', the master has: '+', '.join(known_lanes))
+      watcher.stop()
+      sys.exit(1)
+except CommandError as e:
+  print('Could not list lanes, not checking --lanes: '+str(e))
+admission=AdmissionController(watcher,lanes,args.select_lane,args.max_select_jobs)
+trace=JobTrace(load_job_json)
+
+def on_status(jid,state):
+  admission.on_status(jid,state)
+  trace.on_status(jid,state)
+watcher.on_status=on_status
+
+journal_path=args.journal or os.path.join(args.project_path,'deep2d_'+args.input.replace('.','_')+'.journal')
+if not args.resume and os.path.exists(journal_path) and os.path.getsize(journal_path)>0:
+  # starting fresh would truncate the only record of the jobs the earlier run made
+  print('Journal '+journal_path+' exists: run with --resume to continue it, or move it aside to start over')
+  watcher.stop()
+  sys.exit(1)
+journal=Journal(journal_path,resume=args.resume)
+cache=None
+if not args.no_cache:
+  cache=JobCache(os.path.join(args.project_path,'deep2d_cache.json'),cli,args.pid,load_job_json,max_age_days=args.cache_max_age_days)
+if args.mode=='child':
+  sched.submit(run_node,root,task_name='deep2d '+args.input)
 else:
-  JID=args.input
+  # input is a finished class_2D job
+  sched.submit(run_node,root,args.input,task_name='deep2d '+args.input)
+
+failed=sched.join()
+for task in failed:
+  print('Failed '+task.name+':')
+  print(task.traceback)
+sched.shutdown()
+print('lanes: '+admission.summary())
+watcher.stop()
+journal.close()
+if cache is not None:
+  print('job cache: %d reused, %d new' % (cache.hits,cache.misses))
 
+print_summary(trace.summary())
+if args.trace_out:
+  trace.save(args.trace_out)
+  print('trace written to '+args.trace_out)
 
-if len(JID.split('J'))!=2:
-  print('Error Job got!'+JID)
+print('job tree:')
+print_tree(root)
+if args.tree_out:
+  with open(args.tree_out,'w') as fp:
+    json.dump(root,fp,indent=2)
+if failed:
+  # the tree above is partial; callers can only tell from the exit code
+  print('%d subtree(s) failed' % len(failed))
   sys.exit(1)
- 
-for i in range(K):
-  waiting_list.append('Job_x')
-  thread.start_new_thread(queue_select2d,(JID,i))
-  #queue_select2d(JID,i)
- 
-while(waiting_list!=[]):
-#while(1):
-  pass
-  #time.sleep(10)
-
-print('all job queued.')
-      
-  
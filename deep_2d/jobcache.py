@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# Content-addressed memo of finished class_2D and single_select jobs.
+#
+# A job is keyed by its type, its params, and the identity of each input. The identity
+# of an input is the source job's uid, the output group, the group's particle count and
+# the time the source job completed. Re-running deep2d on the same input with the same
+# K and thresholds finds the completed job and reuses its outputs instead of queueing a
+# new one. The memo lives in the project directory (deep2d_cache.json).
+#
+# Entries are dropped when:
+#   - the cached job is no longer 'completed' (cleared, killed or deleted),
+#   - an input job is no longer 'completed' (cleared inputs invalidate what was built on them),
+#   - they have not been used for max_age_days,
+#   - there are more than max_entries (least recently used go first).
+# A re-run input job completes at a new time, so it gets new keys and never hits stale entries.
+# Only the master's answer evicts an entry: when it can't be reached (a timeout, a restart),
+# the lookup is a miss and the entry is kept for the next run.
+
+
+class JobCache(object):
+
+  def __init__(self, path, cli, project_uid, load_job_json, max_entries=5000, max_age_days=30):
+    self.path = path
+    self.cli = cli
+    self.project_uid = project_uid
+    self.load_job_json = load_job_json
+    self.max_entries = max_entries
+    self.max_age_s = max_age_days * 24 * 3600.0
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self.entries = {}
+    if os.path.exists(path):
+      try:
+        with open(path) as fp:
+          self.entries = json.load(fp)
+      except (IOError, ValueError):
+        print('Job cache %s unreadable, starting empty' % path)
+
+  def input_identity(self, ref):
+    """ identity of an input like 'J12.particles_selected' """
+    job_uid, _, group_name = ref.partition('.')
+    try:
+      job_doc = self.load_job_json(job_uid)
+    except (IOError, ValueError):
+      return None
+    counts = [r.get('num_items') for r in job_doc.get('output_results', []) if r.get('group_name') == group_name]
+    return {'job_uid': job_uid, 'group': group_name, 'num_items': counts[0] if counts else None,
+            'completed_at': job_doc.get('completed_at')}
+
+  def key(self, job_type, params, inputs):
+    """ hex key of a job, or None if an input can't be identified (then the job is never cached) """
+    identities = {}
+    for name, ref in inputs.items():
+      identities[name] = self.input_identity(ref)
+      if identities[name] is None:
+        return None
+    blob = json.dumps([job_type, params, identities], sort_keys=True)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+  def _still_valid(self, entry):
+    """ True if the job and its inputs are all still completed, False if the master says one is not
+    (another status, or an error for that call), None if the master could not be asked """
+    jobs = [entry['job_uid']] + entry['input_jobs']
+    try:
+      states = self.cli.batch([('get_job_status', (self.project_uid, juid)) for juid in jobs])
+    except Exception as e:
+      print('Job cache: could not check %s (%s), not reusing it this time' % (entry['job_uid'], e))
+      return None
+    return all(state == 'completed' for state in states)
+
+  def lookup(self, job_type, params, inputs):
+    """ uid of a completed job with the same params on the same inputs, or None """
+    key = self.key(job_type, params, inputs)
+    if key is None:
+      return None
+    with self._lock:
+      entry = self.entries.get(key)
+    if entry is not None:
+      valid = self._still_valid(entry)
+      if valid is False:
+        print('Job cache: %s is no longer valid, evicted' % entry['job_uid'])
+        with self._lock:
+          self.entries.pop(key, None)
+          self._save()
+      if not valid:
+        entry = None
+    with self._lock:
+      if entry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      entry['last_used'] = time.time()
+      self._save()
+      return entry['job_uid']
+
+  def store(self, job_type, params, inputs, job_uid):
+    key = self.key(job_type, params, inputs)
+    if key is None:
+      return
+    now = time.time()
+    with self._lock:
+      self.entries[key] = {'job_uid': job_uid, 'job_type': job_type, 'input_jobs': sorted(set(r.split('.')[0] for r in inputs.values())),
+                           'created': now, 'last_used': now}
+      self._evict(now)
+      self._save()
+
+  def _evict(self, now):
+    for key in [k for k, e in self.entries.items() if now - e['last_used'] > self.max_age_s]:
+      del self.entries[key]
+    if len(self.entries) > self.max_entries:
+      by_age = sorted(self.entries.items(), key=lambda kv: kv[1]['last_used'])
+      for key, _ in by_age[:len(self.entries) - self.max_entries]:
+        del self.entries[key]
+
+  def _save(self):
+    tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+      json.dump(self.entries, fp)
+    os.rename(tmp_path, self.path)
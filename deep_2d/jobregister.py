@@ -22,11 +22,21 @@
 #                 build time, and actually does all the work. Could be more than one.
 #                 The run module might actually be a .so file if precompiled.
 #                 The run function has a predefined call signature.
+#
+# Importing every job package at startup is slow, and register() also builds a blank job
+# of every type to read its input slots. So what register() records is kept in a
+# manifest (job_manifest.json next to this file), per package, together with the mtimes
+# of the package's files. At startup a package whose files have not changed is taken
+# from the manifest without importing it; its builder is imported by get_builder() and
+# its run module by get_run_function(), the first time the job type is built or run.
+# A package that changed, or is missing from the manifest, is imported as before and
+# its entry rewritten.
 
 
 
 import os
 import sys
+import json
 import inspect
 import importlib
 import common
@@ -227,17 +237,39 @@ job_sections = [
 
 ]
 
+# job packages imported by check_all_job_modules, in import order
+job_packages = [
+    'imports', 'abinit', 'refine', 'local_resolution', 'class2D', 'testjob', 'local_filter',
+    'nonuniform_refine', 'reslog', 'align_3D', 'template_picker_gpu', 'ctf', 'select2D',
+    'manual_picker', 'motioncorrection', 'extract', 'hetero_refine', 'workflows',
+    'curate_exposures', 'fsc3D', 'local_refine', # 'phenix_sharpen',
+    'utilities', 'simulator', 'rtp_workers', 'ctf_estimation', 'create_templates', 'var3D',
+    'topaz', 'ctf_refinement', 'class_probability_filter', 'single_select',
+]
+
+MANIFEST_VERSION = 1
+jobs_mod_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+manifest_path = os.path.join(jobs_mod_dir, 'job_manifest.json')
+
 # this is info about the jobs by name. Only registered jobs show up here.
 job_types_info = {}
-# this is build/run info about the jobs by name
+# this is build/run info about the jobs by name. 'builder' is None until get_builder() imports it.
 job_types_modules = {}
 
+_importing_package = None   # package check_all_job_modules is importing, so register() can attribute its jobs
+_registered_by = {}         # package -> job types it registered
+_info_version = [0]         # bumped whenever job_types_info changes
+_available_cache = [None, None]  # (version, get_available_job_info result)
+
 def register(job_type, 
              title, shorttitle, desc, develop_only,
              builder_class, run_module_name, run_function_name,
              is_interactive = False):
     b = builder_class(common.create_blank_job())
     b.initialize_params_and_inputs()
+    if _importing_package is not None:
+        _registered_by.setdefault(_importing_package, []).append(job_type)
+    _info_version[0] += 1
     job_types_info[job_type] = {
         'name'         : job_type,
         'title'        : title,
@@ -249,10 +281,74 @@ def register(job_type,
     }
     job_types_modules[job_type] = {
         'builder'      : builder_class,    # imported builder class that is a subclass of bc.builderbase
+        'builder_module' : builder_class.__module__,
+        'builder_name' : builder_class.__name__,
         'run_module'   : run_module_name,  # name of a run module
         'run_function' : run_function_name # name of the run function in run module
     }
 
+def package_signature(package):
+    """ (number of files, newest mtime) of a job package's source, or None if it isn't there """
+    path = os.path.join(jobs_mod_dir, package)
+    if not os.path.isdir(path):
+        path = path + '.py'
+        return [1, os.path.getmtime(path)] if os.path.exists(path) else None
+    num_files, newest = 0, 0.0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.endswith(('.py', '.so', '.json')):
+                num_files += 1
+                newest = max(newest, os.path.getmtime(os.path.join(dirpath, filename)))
+    return [num_files, newest]
+
+def load_manifest():
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('packages', {})
+
+def save_manifest(packages):
+    tmp_path = '%s.%d.tmp' % (manifest_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'version' : MANIFEST_VERSION, 'packages' : packages}, f)
+        os.rename(tmp_path, manifest_path)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        # read-only install, or job info that isn't plain json: everything still works, just not faster next time
+        print "  Could not write job manifest:", e
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def manifest_entry(package, signature):
+    jobs = {}
+    for job_type in _registered_by.get(package, []):
+        mods = job_types_modules[job_type]
+        jobs[job_type] = {'info' : job_types_info[job_type],
+                          'builder_module' : mods['builder_module'], 'builder_name' : mods['builder_name'],
+                          'run_module' : mods['run_module'], 'run_function' : mods['run_function']}
+    return {'signature' : signature, 'jobs' : jobs}
+
+def register_from_manifest(entry):
+    for job_type, job in entry['jobs'].items():
+        job_types_info[job_type] = job['info']
+        job_types_modules[job_type] = {'builder' : None,
+                                       'builder_module' : job['builder_module'], 'builder_name' : job['builder_name'],
+                                       'run_module' : job['run_module'], 'run_function' : job['run_function']}
+    _info_version[0] += 1
+
+def import_job_package(package):
+    global _importing_package
+    _importing_package = package
+    _registered_by[package] = []
+    try:
+        importlib.import_module(".."+package, __name__)
+    finally:
+        _importing_package = None
+
 def check_all_job_modules(walk=False):
     """ Walk through subdirs of this module and try to import them. The __init__ in each will register it. 
     By default, don't walk - just directly import the submodules listed. We can bring back walk when we need 
@@ -261,7 +357,7 @@ def check_all_job_modules(walk=False):
         global job_types_info, job_types_modules
         job_types_info = {}
         job_types_modules = {}
-        jobs_mod_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+        _info_version[0] += 1
         all_submods = [path for path in os.listdir(jobs_mod_dir) if os.path.isdir(os.path.join(jobs_mod_dir, path))]
         for submod in all_submods:
             print "Locating availabile job types..."
@@ -273,44 +369,29 @@ def check_all_job_modules(walk=False):
                 print "  Failed to import ", submod
                 print e
     else:
-        import imports
-        import abinit
-        import refine
-        import local_resolution
-        import class2D
-        import testjob
-        import local_filter
-        import nonuniform_refine
-        import reslog
-        import align_3D
-        import template_picker_gpu
-        import ctf
-        import select2D
-        import manual_picker
-        import motioncorrection
-        import extract
-        import hetero_refine
-        import workflows
-        import curate_exposures
-        import fsc3D
-        import local_refine
-        # import phenix_sharpen
-        import utilities
-        import simulator
-        import rtp_workers
-        import ctf_estimation
-        import create_templates
-        import var3D
-        import topaz
-        import ctf_refinement
-        import class_probability_filter
-        import single_select
+        manifest = load_manifest()
+        changed = False
+        for package in job_packages:
+            signature = package_signature(package)
+            entry = manifest.get(package)
+            if signature is not None and entry is not None and entry['signature'] == signature:
+                register_from_manifest(entry)
+                continue
+            import_job_package(package)
+            if signature is not None:
+                manifest[package] = manifest_entry(package, signature)
+                changed = True
+        if changed:
+            save_manifest(manifest)
 
 def list_job_types():
     return sorted(job_types_info.keys())
 
 def get_available_job_info():
-    """ returns a denormalized structure with the sections and their info, plus the jobs and their info """
+    """ returns a denormalized structure with the sections and their info, plus the jobs and their info.
+    Built once and then served from cache until a job is registered again; callers must not modify it. """
+    if _available_cache[0] == _info_version[0]:
+        return _available_cache[1]
     struct = []
     for sec in job_sections:
         secinfo = sec.copy()
@@ -320,13 +401,18 @@ def get_available_job_info():
                 secinfo['contains'].append(job_types_info[jobname])
         if len(secinfo['contains']) > 0:
             struct.append(secinfo)
+    _available_cache[0], _available_cache[1] = _info_version[0], struct
     return struct
 
 def job_type_exists(job_type):
     return job_type in job_types_modules
 
 def get_builder(job_type):
-    return job_types_modules[str(job_type)]['builder']
+    mods = job_types_modules[str(job_type)]
+    if mods['builder'] is None:
+        # registered from the manifest: import the builder now (its package registers itself again on import)
+        mods['builder'] = getattr(importlib.import_module(mods['builder_module']), mods['builder_name'])
+    return mods['builder']
 
 def get_run_function(job_type):
     modname = job_types_modules[str(job_type)]['run_module']
@@ -0,0 +1,167 @@
+import sys
+import json
+import time
+import threading
+
+from planner import timestamp
+
+# Timeline of every job a deep2d run makes.
+#
+# Each job gets five timestamps:
+#   created   deep2d set out to make the job            (deep2d clock)
+#   enqueued  enqueue_job returned, after admission     (deep2d clock)
+#   started   the job started running                   (job.json started_at, else when the watcher saw 'running')
+#   completed the job finished                          (job.json completed_at)
+#   observed  the watcher saw the final status          (deep2d clock)
+# so a job's wall time splits into admission, queued, running and poll lag (how long
+# the job sat finished before the next status poll noticed). The started and completed
+# times come from the master's clock; on another machine they are only as good as the
+# clock sync.
+#
+# save() writes the Chrome trace event format (open in chrome://tracing or
+# ui.perfetto.dev), one row per job grouped by lane; the raw timestamps are kept in the
+# same file under 'deep2d_jobs', and `python jobtrace.py trace.json` prints the summary
+# again from it.
+
+SPANS = (('created', 'enqueued', 'admission'),
+         ('enqueued', 'started', 'queued'),
+         ('started', 'completed', 'running'),
+         ('completed', 'observed', 'poll lag'))
+
+
+def _span(rec, begin, end):
+  if rec.get(begin) is None or rec.get(end) is None:
+    return None
+  return max(rec[end] - rec[begin], 0.0)
+
+
+class JobTrace(object):
+
+  def __init__(self, load_job_json=None, t0=None):
+    self.load_job_json = load_job_json
+    self.t0 = time.time() if t0 is None else t0
+    self.jobs = {}  # job_uid -> {'job_uid', 'job_type', 'lane', 'inputs', 'status', <event>: t}
+    self._lock = threading.Lock()
+
+  def mark(self, job_uid, event=None, t=None, **fields):
+    """ record the first time event happened to job_uid, plus any fields """
+    with self._lock:
+      rec = self.jobs.setdefault(job_uid, {'job_uid': job_uid})
+      rec.update(fields)
+      if event is not None and rec.get(event) is None:
+        rec[event] = time.time() if t is None else t
+
+  def on_status(self, job_uid, state):
+    """ JobWatcher on_status hook """
+    if job_uid not in self.jobs:
+      return
+    if state == 'running':
+      self.mark(job_uid, 'started')
+    elif state in ('completed', 'failed', 'killed'):
+      self.mark(job_uid, 'observed', status=state)
+      self._read_job_times(job_uid)
+
+  def _read_job_times(self, job_uid):
+    if self.load_job_json is None:
+      return
+    try:
+      job_doc = self.load_job_json(job_uid)
+    except (IOError, ValueError):
+      return
+    started = timestamp(job_doc.get('started_at'))
+    completed = timestamp(job_doc.get('completed_at'))
+    with self._lock:
+      rec = self.jobs[job_uid]
+      if started is not None:
+        rec['started'] = started
+      if completed is not None:
+        rec['completed'] = completed
+
+  def traced_jobs(self):
+    """ jobs this run queued and saw finish, in the order they were created """
+    with self._lock:
+      recs = [dict(rec) for rec in self.jobs.values() if rec.get('created') is not None and rec.get('observed') is not None]
+    return sorted(recs, key=lambda rec: rec['created'])
+
+  def chrome_trace(self):
+    events = []
+    lanes = {}
+    for tid, rec in enumerate(self.traced_jobs()):
+      pid = lanes.setdefault(rec.get('lane') or 'default', len(lanes) + 1)
+      events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid,
+                     'args': {'name': '%s %s' % (rec['job_uid'], rec.get('job_type', ''))}})
+      for begin, end, name in SPANS:
+        dur = _span(rec, begin, end)
+        if dur is None:
+          continue
+        events.append({'ph': 'X', 'name': name, 'cat': rec.get('job_type', 'job'), 'pid': pid, 'tid': tid,
+                       'ts': (rec[begin] - self.t0) * 1e6, 'dur': dur * 1e6,
+                       'args': {'job_uid': rec['job_uid'], 'key': rec.get('key'), 'status': rec.get('status')}})
+    for name, pid in lanes.items():
+      events.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'args': {'name': 'lane ' + name}})
+    return events
+
+  def save(self, path):
+    with open(path, 'w') as fp:
+      json.dump({'traceEvents': self.chrome_trace(), 'displayTimeUnit': 'ms',
+                 'deep2d_t0': self.t0, 'deep2d_jobs': self.traced_jobs()}, fp)
+
+  @classmethod
+  def load(cls, path):
+    with open(path) as fp:
+      doc = json.load(fp)
+    trace = cls(t0=doc['deep2d_t0'])
+    for rec in doc['deep2d_jobs']:
+      trace.jobs[rec['job_uid']] = rec
+    return trace
+
+  def critical_path(self):
+    """ the chain of jobs that ended last, walked back through each job's latest finishing input """
+    recs = dict((rec['job_uid'], rec) for rec in self.traced_jobs())
+    if len(recs) == 0:
+      return []
+    path = [max(recs.values(), key=lambda rec: rec['observed'])]
+    while True:
+      inputs = [recs[j] for j in path[-1].get('inputs', []) if j in recs]
+      if len(inputs) == 0:
+        break
+      path.append(max(inputs, key=lambda rec: rec['observed']))
+    return path[::-1]
+
+  def summary(self):
+    recs = self.traced_jobs()
+    if len(recs) == 0:
+      return None
+    totals = dict((name, sum(_span(rec, b, e) or 0.0 for rec in recs)) for b, e, name in SPANS)
+    lags = sorted(_span(rec, 'completed', 'observed') for rec in recs if _span(rec, 'completed', 'observed') is not None)
+    path = self.critical_path()
+    on_path = dict((name, sum(_span(rec, b, e) or 0.0 for rec in path)) for b, e, name in SPANS)
+    # time between an input being seen finished and the next job on the path being made
+    gaps = [path[0]['created'] - self.t0] + [b['created'] - a['observed'] for a, b in zip(path[:-1], path[1:])]
+    on_path['deep2d'] = sum(max(g, 0.0) for g in gaps)
+    return {'num_jobs': len(recs),
+            'wall_s': max(rec['observed'] for rec in recs) - self.t0,
+            'job_totals_s': totals,
+            'critical_path': [rec['job_uid'] for rec in path],
+            'critical_path_s': on_path,
+            'poll_lag_s': {'mean': sum(lags) / len(lags) if lags else None,
+                           'median': lags[len(lags) // 2] if lags else None,
+                           'max': lags[-1] if lags else None}}
+
+
+def print_summary(summary):
+  if summary is None:
+    print('trace: no jobs')
+    return
+  print('trace: %d jobs, %.1f s wall' % (summary['num_jobs'], summary['wall_s']))
+  print('  summed over jobs: ' + ', '.join('%s %.1f s' % (name, summary['job_totals_s'][name]) for _, _, name in SPANS))
+  path = summary['critical_path_s']
+  print('  critical path %s: %s' % (' > '.join(summary['critical_path']),
+                                    ', '.join('%s %.1f s' % (name, path[name]) for name in [s[2] for s in SPANS] + ['deep2d'])))
+  lag = summary['poll_lag_s']
+  if lag['mean'] is not None:
+    print('  poll lag per job: mean %.1f s, median %.1f s, max %.1f s' % (lag['mean'], lag['median'], lag['max']))
+
+
+if __name__ == '__main__':
+  print_summary(JobTrace.load(sys.argv[1]).summary())
@@ -0,0 +1,151 @@
+import time
+import threading
+
+from commandclient import CommandError
+
+# One background thread that watches the status of every outstanding job.
+#
+# Instead of each waiting thread polling get_job_status on its own, callers register
+# the jobs they care about and get a JobFuture back. Each tick the watcher asks for
+# the status of all outstanding jobs in a single batched round trip, so the load on
+# the command server stays constant however many jobs a run has fanned out.
+#
+# The poll interval starts at min_interval, grows by `backoff` on every tick where
+# no job changed status, and drops back to min_interval as soon as one does.
+#
+#   watcher = JobWatcher(cli, 'P1', min_interval=10, max_interval=120)
+#   watcher.start()
+#   state = watcher.watch('J12').result()    # blocks until J12 is completed/failed/killed
+
+TERMINAL_STATES = ('completed', 'failed', 'killed')
+
+
+class JobFuture(object):
+  """ Resolves with the final status string of one job. """
+
+  def __init__(self, job_uid):
+    self.job_uid = job_uid
+    self.state = None
+    self._event = threading.Event()
+    self._callbacks = []
+    self._lock = threading.Lock()
+
+  def done(self):
+    return self._event.is_set()
+
+  def result(self, timeout=None):
+    # wait in slices so that KeyboardInterrupt still reaches the main thread on python 2
+    deadline = None if timeout is None else time.time() + timeout
+    while not self._event.is_set():
+      remaining = 1.0 if deadline is None else min(1.0, deadline - time.time())
+      if remaining <= 0:
+        raise RuntimeError('Timed out waiting for job %s' % self.job_uid)
+      self._event.wait(remaining)
+    return self.state
+
+  def add_done_callback(self, fn):
+    """ fn(future) is called from the watcher thread when the job finishes, or right away if it already has """
+    with self._lock:
+      if not self._event.is_set():
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+  def _set(self, state):
+    with self._lock:
+      self.state = state
+      self._event.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for fn in callbacks:
+      try:
+        fn(self)
+      except Exception as e:
+        print('Error in callback for job %s: %s' % (self.job_uid, e))
+
+
+class JobWatcher(threading.Thread):
+
+  def __init__(self, cli, project_uid, min_interval=10, max_interval=120, backoff=1.5, on_status=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.cli = cli
+    self.project_uid = project_uid
+    self.min_interval = min_interval
+    self.max_interval = max(min_interval, max_interval)
+    self.backoff = backoff
+    self.interval = min_interval
+    self.on_status = on_status  # optional on_status(job_uid, state), called whenever a job's status changes
+    self.num_polls = 0
+    self._futures = {}  # job_uid -> [JobFuture, ...]
+    self._last_state = {}
+    self._cond = threading.Condition()
+    self._stopped = False
+
+  def watch(self, job_uid):
+    """ start watching job_uid; returns a JobFuture resolved with its final status """
+    fut = JobFuture(job_uid)
+    with self._cond:
+      if len(self._futures) == 0:
+        self._cond.notify()  # wake the idle watcher; otherwise the job joins the next tick's batch
+      self._futures.setdefault(job_uid, []).append(fut)
+    return fut
+
+  def wait(self, job_uid, timeout=None):
+    return self.watch(job_uid).result(timeout)
+
+  def last_state(self, job_uid):
+    return self._last_state.get(job_uid)
+
+  def stop(self):
+    with self._cond:
+      self._stopped = True
+      self._cond.notify()
+    if self.is_alive() and threading.current_thread() is not self:
+      self.join()
+
+  def poll(self):
+    """ one batched status round trip for all outstanding jobs; returns True if any status changed """
+    with self._cond:
+      job_uids = list(self._futures.keys())
+    if len(job_uids) == 0:
+      return False
+    self.num_polls += 1
+    try:
+      states = self.cli.batch([('get_job_status', (self.project_uid, juid)) for juid in job_uids])
+    except Exception as e:
+      print('Job status poll failed: %s' % e)
+      return False
+    changed = False
+    finished = []
+    for juid, state in zip(job_uids, states):
+      if isinstance(state, CommandError) or not state:
+        continue
+      if self._last_state.get(juid) != state:
+        changed = True
+        self._last_state[juid] = state
+        if self.on_status is not None:
+          self.on_status(juid, state)
+      if state in TERMINAL_STATES:
+        finished.append((juid, state))
+    for juid, state in finished:
+      with self._cond:
+        futures = self._futures.pop(juid, [])
+      for fut in futures:
+        fut._set(state)
+    return changed
+
+  def run(self):
+    while True:
+      with self._cond:
+        while not self._stopped and len(self._futures) == 0:
+          self.interval = self.min_interval
+          self._cond.wait()
+        if self._stopped:
+          return
+      if self.poll():
+        self.interval = self.min_interval
+      else:
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+      with self._cond:
+        if not self._stopped:
+          self._cond.wait(self.interval)
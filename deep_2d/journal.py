@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import threading
+
+# Append-only, crash-safe journal of the jobs a deep2d run creates.
+#
+# Every job is recorded under a key that is derived only from its inputs (e.g.
+# 'class_2D J12.particles_selected'), so a restarted run computes the same keys and
+# can find the jobs it made before. One JSON object per line, flushed and fsynced
+# before the call returns, so a crash loses at most the line being written:
+#
+#   {"t": 1606.1, "event": "created",  "key": "class_2D J1.particles_selected", "job_uid": "J2", "K": 40}
+#   {"t": 1606.2, "event": "enqueued", "key": "class_2D J1.particles_selected", "job_uid": "J2"}
+#   {"t": 9112.7, "event": "completed", "key": "class_2D J1.particles_selected", "job_uid": "J2"}
+#
+# Replaying the file gives the latest state of every key. A truncated last line from
+# a crash is skipped.
+
+EVENTS = ('created', 'enqueued', 'completed', 'failed')
+
+
+class Journal(object):
+
+  def __init__(self, path, resume=False):
+    self.path = path
+    self.entries = {}  # key -> {'job_uid', 'state', plus any extra fields recorded}
+    self._lock = threading.Lock()
+    if resume and os.path.exists(path):
+      self.replay()
+    self._fp = open(path, 'a' if resume else 'w')
+
+  def replay(self):
+    with open(self.path) as fp:
+      for line in fp:
+        try:
+          rec = json.loads(line)
+        except ValueError:
+          continue
+        self._apply(rec)
+    return self.entries
+
+  def _apply(self, rec):
+    entry = self.entries.setdefault(rec['key'], {})
+    entry.update(dict((k, v) for k, v in rec.items() if k not in ('t', 'event', 'key')))
+    entry['state'] = rec['event']
+
+  def record(self, event, key, job_uid, **extra):
+    assert event in EVENTS
+    rec = dict(extra, t=time.time(), event=event, key=key, job_uid=job_uid)
+    with self._lock:
+      self._fp.write(json.dumps(rec) + '\n')
+      self._fp.flush()
+      os.fsync(self._fp.fileno())
+      self._apply(rec)
+
+  def lookup(self, key):
+    """ latest entry for key, or None. Failed jobs count as missing so they are made again. """
+    with self._lock:
+      entry = self.entries.get(key)
+      if entry is None or entry['state'] == 'failed':
+        return None
+      return dict(entry)
+
+  def close(self):
+    with self._lock:
+      self._fp.close()
@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import argparse
+
+try:
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from SocketServer import ThreadingMixIn
+except ImportError:
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+  from socketserver import ThreadingMixIn
+
+# Local stand-in for the cryoSPARC command server, so deep2d.py can be run without cryoSPARC.
+#
+#   python mockmaster.py --port 39002 --project_path /tmp/P1
+#   python deep2d.py --master_hostname localhost --command_port 39002 --project_path /tmp/P1 --input J1
+#
+# It speaks the same JSON-RPC over HTTP as command_core (plus JSON-RPC batches) and
+# implements only the calls deep2d makes. Enqueued jobs run for --duration seconds and then complete. When
+# --project_path is given a job.json is written for every finished job, with particle
+# counts passed down from the job's inputs and split unevenly over the classes. A split
+# single_select declares particles_selected_<k> for every class, as build.py does, but
+# like the real job writes nothing for classes at or below particle_count_above: those
+# results come back with empty num_items.
+#
+# --duration is one number of seconds for every job, or per job type
+# (class_2D=60,single_select=2,default=5); --jitter spreads every duration uniformly by
+# that fraction either way. --failure_rate makes that fraction of jobs end 'failed', with
+# no outputs. --seed makes durations and failures repeatable. Jobs advance on a clock
+# thread every --tick seconds, as they would on a real master, not when they are polled.
+#
+# get_stats() (mock only) reports requests, calls per method, server time and job counts;
+# benchmarks/loadtest_deep2d.py uses it to load-test deep2d with thousands of jobs.
+#
+# --lanes default:2,gpu2:2 simulates a cluster scheduler: each lane runs at most that many
+# jobs at once and the rest wait queued, in the order they were enqueued. get_lane_stats()
+# (mock only) reports the deepest queue and the most running jobs seen on each lane.
+
+
+class MockMaster(object):
+
+  def __init__(self, project_path=None, duration=1.0, num_items=1000, class_decay=0.5, lanes=None,
+               jitter=0.0, failure_rate=0.0, seed=None):
+    self.project_path = project_path
+    self.durations = duration if isinstance(duration, dict) else {'default': duration}
+    self.jitter = jitter
+    self.failure_rate = failure_rate
+    self.rng = random.Random(seed)
+    self.num_items = num_items
+    self.class_decay = class_decay
+    self.lanes = dict(lanes or {})  # lane name -> jobs it runs at once; no lanes means unlimited
+    self.lane_stats = dict((name, {'peak_queued': 0, 'peak_running': 0}) for name in self.lanes)
+    self.jobs = {}
+    self.lock = threading.Lock()
+    self.stats = {'requests': 0, 'calls': {}, 'server_s': 0.0, 'started': 0, 'completed': 0, 'failed': 0}
+
+  def _duration(self, job):
+    base = self.durations.get(job['job_type'], self.durations.get('default', 1.0))
+    return base * (1.0 + self.rng.uniform(-self.jitter, self.jitter))
+
+  def _input_items(self, job, group='particles'):
+    # particle count of the output a job's input group is connected to ('J3.particles_selected')
+    ref = job['inputs'].get(group)
+    if not ref or ref.split('.')[0] not in self.jobs:
+      return self.num_items
+    src = self.jobs[ref.split('.')[0]]
+    groups = self.output_groups(src)
+    name = ref.split('.')[1] if '.' in ref else None
+    if name in groups:
+      return groups[name] or 0
+    return (list(groups.values())[0] or 0) if groups else self.num_items
+
+  def _class_share(self, num_items, num_classes, class_idx):
+    # class sizes fall off geometrically, so a few classes are big enough to recurse into
+    weights = [self.class_decay ** k for k in range(num_classes)]
+    return int(num_items * weights[class_idx] / sum(weights))
+
+  def output_groups(self, job):
+    """ {group_name: num_items} of a job, derived from its type, params and inputs; None for declared
+    results the job wrote nothing to """
+    params = job['params']
+    if job['job_type'] == 'class_2D':
+      n = self._input_items(job)
+      return {'particles': n, 'class_averages': int(params.get('class2D_K', 1))}
+    if job['job_type'] == 'single_select':
+      n = self._input_items(job)
+      K = self._input_items(job, 'templates')
+      if params.get('split_class_idxs') == 'all':
+        K = int(params.get('split_num_classes', K))
+        above = int(params.get('particle_count_above') or 0)
+        shares = [self._class_share(n, K, k) for k in range(K)]
+        return dict(('particles_selected_%d' % k, share if share > above else None) for k, share in enumerate(shares))
+      k = int(params.get('class_idx', 0))
+      selected = self._class_share(n, K, k) if k < K else 0
+      return {'particles_selected': selected, 'particles_excluded': n - selected}
+    return {'particles_selected': self.num_items}
+
+  def _tick(self):
+    # advance every job: finish the ones that ran their time, then start queued ones where their lane has room
+    now = time.time()
+    running = {}
+    queued = []
+    for job in self.jobs.values():
+      if job['status'] == 'running' and now >= job['ends_at']:
+        job['status'] = job['outcome']
+        job['completed_at'] = job['ends_at']
+        self.stats[job['outcome']] += 1
+        self.write_job_json(job)
+      if job['status'] == 'running':
+        running[job['lane']] = running.get(job['lane'], 0) + 1
+      elif job['status'] == 'queued':
+        queued.append(job)
+    queued.sort(key=lambda j: j['queued_at'])
+    for job in queued:
+      slots = self.lanes.get(job['lane'])
+      if slots is None or running.get(job['lane'], 0) < slots:
+        running[job['lane']] = running.get(job['lane'], 0) + 1
+        job['status'] = 'running'
+        job['started_at'] = now
+        job['ends_at'] = now + self._duration(job)
+        job['outcome'] = 'failed' if self.rng.random() < self.failure_rate else 'completed'
+        self.stats['started'] += 1
+    for name in self.lanes:
+      stats = self.lane_stats[name]
+      stats['peak_queued'] = max(stats['peak_queued'], len([j for j in queued if j['lane'] == name and j['status'] == 'queued']))
+      stats['peak_running'] = max(stats['peak_running'], running.get(name, 0))
+
+  def write_job_json(self, job):
+    if self.project_path is None:
+      return
+    job_dir = os.path.join(self.project_path, job['uid'])
+    if not os.path.isdir(job_dir):
+      os.makedirs(job_dir)
+    with open(os.path.join(job_dir, 'job.json'), 'w') as fp:
+      json.dump({
+        'uid': job['uid'],
+        'job_type': job['job_type'],
+        'status': job['status'],
+        'started_at': {'$date': int(job['started_at'] * 1000)} if job.get('started_at') else None,
+        'completed_at': {'$date': int(job['completed_at'] * 1000)} if job.get('completed_at') else None,
+        'params_spec': dict((k, {'value': v}) for k, v in job['params'].items()),
+        'output_results': [{'group_name': g, 'name': 'blob', 'num_items': [] if c is None else [c]} for g, c in sorted(self.output_groups(job).items())]
+                          if job['status'] == 'completed' else [],
+      }, fp)
+
+  # ---- command_core api ------------------------------------------------------
+
+  def make_job(self, job_type, project_uid, workspace_uid, user_id, title=None, desc=None, params={}, input_group_connects={}):
+    with self.lock:
+      num = len(self.jobs) + 1
+      while 'J%d' % num in self.jobs:
+        num += 1
+      uid = 'J%d' % num
+      self.jobs[uid] = {'uid': uid, 'job_type': job_type, 'project_uid': project_uid, 'status': 'building',
+                        'params': params or {}, 'inputs': input_group_connects or {}, 'queued_at': None}
+      return uid
+
+  def enqueue_job(self, project_uid, job_uid, lane=None):
+    with self.lock:
+      if self.lanes and lane not in self.lanes:
+        raise ValueError('Unknown lane %s' % lane)
+      job = self.jobs[job_uid]
+      job['status'] = 'queued'
+      job['lane'] = lane
+      job['queued_at'] = time.time()
+      return 'queued'
+
+  def get_job_status(self, project_uid, job_uid):
+    with self.lock:
+      return self.jobs[job_uid]['status']
+
+  def get_scheduler_lanes(self):
+    return [{'name': name, 'title': name, 'type': 'cluster'} for name in sorted(self.lanes)] or [{'name': 'default', 'title': 'default', 'type': 'node'}]
+
+  def get_lane_stats(self):
+    with self.lock:
+      return self.lane_stats
+
+  def get_stats(self):
+    with self.lock:
+      stats = dict(self.stats, calls=dict(self.stats['calls']), num_jobs=len(self.jobs))
+      stats['lanes'] = dict((name, dict(v)) for name, v in self.lane_stats.items())
+      return stats
+
+  def add_completed_job(self, job_uid):
+    """ register an already finished job, e.g. the input of a deep2d run """
+    with self.lock:
+      self.jobs[job_uid] = {'uid': job_uid, 'job_type': 'import_particles', 'project_uid': None, 'status': 'completed',
+                            'params': {}, 'inputs': {}, 'queued_at': None}
+      self.write_job_json(self.jobs[job_uid])
+
+
+def parse_durations(spec):
+  """ '5' -> 5.0 for every job; 'class_2D=60,single_select=2' -> {'class_2D': 60.0, 'single_select': 2.0} """
+  if '=' not in spec:
+    return float(spec)
+  return dict((k.strip(), float(v)) for k, v in (item.split('=') for item in spec.split(',') if item.strip()))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+def make_handler(master):
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+      pass
+
+    def _dispatch(self, req):
+      res = {'jsonrpc': '2.0', 'id': req.get('id')}
+      func = getattr(master, req.get('method', ''), None)
+      if req.get('method', '').startswith('_') or func is None:
+        res['error'] = {'code': -32601, 'message': 'Method not found: %s' % req.get('method')}
+        return res
+      params = req.get('params', [])
+      try:
+        res['result'] = func(**params) if isinstance(params, dict) else func(*params)
+      except Exception as e:
+        res['error'] = {'code': -32000, 'message': repr(e)}
+      return res
+
+    def do_POST(self):
+      tic = time.time()
+      length = int(self.headers.get('Content-Length', 0))
+      req = json.loads(self.rfile.read(length))
+      if isinstance(req, list):
+        res = [self._dispatch(r) for r in req]
+      else:
+        res = self._dispatch(req)
+      with master.lock:
+        master.stats['requests'] += 1
+        for r in (req if isinstance(req, list) else [req]):
+          master.stats['calls'][r.get('method')] = master.stats['calls'].get(r.get('method'), 0) + 1
+        master.stats['server_s'] += time.time() - tic
+      body = json.dumps(res).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+  return Handler
+
+
+def _clock(master, interval):
+  # jobs advance on their own, like on a real master, not only when somebody asks for their status
+  while True:
+    time.sleep(interval)
+    with master.lock:
+      master._tick()
+
+
+def serve(master, host='localhost', port=0, tick=0.1):
+  """ start serving master in a background thread; returns the server (server.server_address has the port) """
+  clock = threading.Thread(target=_clock, args=(master, tick))
+  clock.daemon = True
+  clock.start()
+  server = _ThreadingHTTPServer((host, port), make_handler(master))
+  t = threading.Thread(target=server.serve_forever)
+  t.daemon = True
+  t.start()
+  return server
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', type=str, default='localhost')
+  parser.add_argument('--port', type=int, default=39002)
+  parser.add_argument('--project_path', type=str, default=None)
+  parser.add_argument('--duration', type=str, default='1.0', help='seconds per job, or per job type: class_2D=60,single_select=2,default=5')
+  parser.add_argument('--jitter', type=float, default=0.0, help='spread durations by up to this fraction either way')
+  parser.add_argument('--failure_rate', type=float, default=0.0, help='fraction of jobs that end failed')
+  parser.add_argument('--seed', type=int, default=None)
+  parser.add_argument('--tick', type=float, default=0.1, help='seconds between job state updates')
+  parser.add_argument('--num_items', type=int, default=1000)
+  parser.add_argument('--lanes', type=str, default='', help='simulated lanes and the jobs each runs at once, e.g. default:2,gpu2:2')
+  parser.add_argument('--completed', type=str, default='', help='comma separated job uids that already exist as completed')
+  args = parser.parse_args()
+
+  lanes = [(lane.split(':')[0], int(lane.split(':')[1])) for lane in filter(None, args.lanes.split(','))]
+  master = MockMaster(args.project_path, parse_durations(args.duration), args.num_items, lanes=lanes,
+                      jitter=args.jitter, failure_rate=args.failure_rate, seed=args.seed)
+  for uid in filter(None, args.completed.split(',')):
+    master.add_completed_job(uid)
+  server = serve(master, args.host, args.port, args.tick)
+  print('mock command server listening on %s:%d' % server.server_address)
+  sys.stdout.flush()
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
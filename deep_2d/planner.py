@@ -0,0 +1,174 @@
+import os
+import json
+import glob
+
+import numpy as n
+
+# Cost model and planner for deep2d.
+#
+# class_2D runtime is modelled as
+#   t = a + b * N * B^2 + c * N * K * B^2        (seconds)
+# for N particles, K classes and box size B: a fixed startup cost, a per-particle cost
+# (reading and transforming every image) and a per-particle-per-class cost (the
+# alignment against every class). The coefficients are fitted to the completed class_2D
+# jobs found in the project directory, with B read from blob/shape in each job's particles
+# .cs file (job docs don't record it); with too little history the defaults are used.
+#
+#   python benchmarks/check_cost_model.py   fits a synthetic history and checks the result
+#
+# The planner picks K from the usual N*4/num_thre rule, capped so every class can get at
+# least min_per_class particles, and then lowered until the model predicts one class_2D
+# stays under a time budget (12 h unless deep2d is given --max_class2d_hours), and
+# predicts the whole job tree of a deep2d run for --dry_run.
+
+DEFAULT_COEFS = (300.0, 1.5e-8, 7.5e-10) # about 1.5 h for 1M particles, K=100, box 256
+
+
+def timestamp(value):
+  """ seconds from a job.json date: {'$date': ms}, ms, or None """
+  if isinstance(value, dict):
+    value = value.get('$date')
+  if isinstance(value, (int, float)):
+    return value / 1000.0
+  return None
+
+
+def particle_box(job_doc, project_path):
+  """ box size of the particles of a job doc, from blob/shape in their .cs file, or None """
+  for r in job_doc.get('output_results', []):
+    if r.get('group_name') == 'particles' and r.get('name') == 'blob' and r.get('metafiles'):
+      try:
+        blob = n.load(os.path.join(project_path, r['metafiles'][-1]), mmap_mode='r')
+        return int(blob['blob/shape'][0][0])
+      except (IOError, OSError, ValueError, KeyError, IndexError):
+        return None
+  return None
+
+
+def job_record(job_doc, project_path):
+  """ (num_particles, K, box, runtime_s) of a completed class_2D job doc, or None """
+  if job_doc.get('job_type') != 'class_2D' or job_doc.get('status') != 'completed':
+    return None
+  try:
+    K = int(job_doc['params_spec']['class2D_K']['value'])
+    counts = [int(r['num_items'][0]) for r in job_doc.get('output_results', []) if r.get('group_name') == 'particles']
+    start = timestamp(job_doc.get('started_at'))
+    end = timestamp(job_doc.get('completed_at'))
+  except (KeyError, ValueError, TypeError, IndexError):
+    return None
+  box = particle_box(job_doc, project_path)
+  if len(counts) == 0 or start is None or end is None or box is None:
+    return None
+  return (counts[0], K, box, end - start)
+
+
+def load_history(project_path):
+  records = []
+  for path in glob.glob(os.path.join(project_path, 'J*', 'job.json')):
+    try:
+      with open(path) as fp:
+        rec = job_record(json.load(fp), project_path)
+    except (IOError, ValueError):
+      continue
+    if rec is not None:
+      records.append(rec)
+  return records
+
+
+class CostModel(object):
+
+  def __init__(self, coefs=DEFAULT_COEFS):
+    self.coefs = n.array(coefs, dtype=n.float64)
+    self.num_records = 0
+
+  @staticmethod
+  def features(num_particles, K, box):
+    pix = float(box) ** 2
+    return n.array([1.0, num_particles * pix, num_particles * K * pix])
+
+  def fit(self, records, min_records=3):
+    """ least squares fit of the coefficients to (N, K, box, runtime) records; keeps the defaults with too few """
+    if len(records) < min_records:
+      return self
+    X = n.array([self.features(N, K, box) for N, K, box, _ in records])
+    y = n.array([t for _, _, _, t in records], dtype=n.float64)
+    # scale columns so the solve is well conditioned, and keep every cost non-negative
+    scale = n.maximum(n.abs(X).max(axis=0), 1e-30)
+    active = list(range(X.shape[1]))
+    while True:
+      coefs, _, _, _ = n.linalg.lstsq(X[:, active] / scale[active], y, rcond=None)
+      if (coefs >= 0).all() or len(active) == 1:
+        break
+      del active[int(n.argmin(coefs))]
+    self.coefs = n.zeros(X.shape[1])
+    self.coefs[active] = n.maximum(coefs, 0) / scale[active]
+    self.num_records = len(records)
+    return self
+
+  def predict(self, num_particles, K, box):
+    """ predicted class_2D runtime in seconds """
+    return float(self.features(num_particles, K, box).dot(self.coefs))
+
+
+def choose_k(num_particles, num_thre, model, box, max_k=200, min_per_class=1000, max_hours=None):
+  K = num_particles * 4 // num_thre
+  K = min(K, max_k, num_particles // max(min_per_class, 1))
+  K = max(K, 2)
+  if max_hours:
+    while K > 2 and model.predict(num_particles, K, box) > max_hours * 3600.0:
+      K -= 1
+  return int(K)
+
+
+def class_sizes(num_particles, K, class_decay):
+  """ assumed class sizes: geometric fall-off, which is what classifying a heterogeneous subset tends to give """
+  weights = class_decay ** n.arange(K)
+  return [int(num_particles * w / weights.sum()) for w in weights]
+
+
+def plan_tree(num_particles, num_thre, model, box, depth, level=1, class_decay=0.5, select_s=60.0, given_k=None, **kw):
+  """ predicted job tree: nested dicts with the K, class_2D runtime and children of every node.
+  given_k is the K of a class_2D that already ran on the root; it is selected from, not queued again. """
+  node = {'num_particles': int(num_particles), 'level': level, 'K': None, 'given': given_k is not None,
+          'class2d_s': 0.0, 'select_s': 0.0, 'children': []}
+  if given_k is not None:
+    node['K'] = given_k
+  elif num_particles <= num_thre:
+    return node
+  else:
+    node['K'] = choose_k(num_particles, num_thre, model, box, **kw)
+    node['class2d_s'] = model.predict(num_particles, node['K'], box)
+  node['select_s'] = select_s
+  if level < depth:
+    for size in class_sizes(num_particles, node['K'], class_decay):
+      if size > num_thre:
+        node['children'].append(plan_tree(size, num_thre, model, box, depth, level + 1, class_decay, select_s, **kw))
+  return node
+
+
+def summarize(tree, max_jobs=4):
+  """ (number of class_2D jobs, GPU hours, predicted wall hours) of a planned tree """
+  def walk(node):
+    own = node['class2d_s'] + node['select_s']
+    jobs, gpu_s, path_s = (1 if node['K'] and not node['given'] else 0), node['class2d_s'], own
+    for child in node['children']:
+      c_jobs, c_gpu, c_path = walk(child)
+      jobs += c_jobs
+      gpu_s += c_gpu
+      path_s = max(path_s, own + c_path)
+    return jobs, gpu_s, path_s
+  jobs, gpu_s, path_s = walk(tree)
+  # no faster than the critical path, nor than the total work spread over max_jobs subtrees
+  wall_s = max(path_s, gpu_s / float(max_jobs))
+  return jobs, gpu_s / 3600.0, wall_s / 3600.0
+
+
+def print_plan(tree, indent=''):
+  if tree['given']:
+    print('%s%d particles: given class_2D K=%d' % (indent, tree['num_particles'], tree['K']))
+  elif tree['K']:
+    print('%s%d particles: class_2D K=%d, %.2f h' % (indent, tree['num_particles'], tree['K'], tree['class2d_s'] / 3600.0))
+  else:
+    print('%s%d particles: stop' % (indent, tree['num_particles']))
+  for child in tree['children']:
+    print_plan(child, indent + '  ')
@@ -0,0 +1,112 @@
+import sys
+import threading
+import traceback
+
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+# Bounded worker pool for the deep2d fan-out.
+#
+# At most max_job_num tasks run at once; the rest wait in a FIFO queue. Tasks may
+# submit more tasks. join() blocks (no busy wait) until every task submitted so far,
+# including those submitted while joining, has finished. An exception raised by a
+# task is captured on its Task and does not stop the other tasks.
+#
+#   sched = Scheduler(max_job_num=4)
+#   for i in range(K):
+#     sched.submit(queue_select2d, JID, i)
+#   failed = sched.join()
+
+
+class Task(object):
+
+  def __init__(self, fn, args, kwargs, name=None):
+    self.fn = fn
+    self.args = args
+    self.kwargs = kwargs
+    self.name = name or '%s%r' % (getattr(fn, '__name__', 'task'), args)
+    self.result = None
+    self.error = None
+    self.traceback = None
+    self._done = threading.Event()
+
+  def done(self):
+    return self._done.is_set()
+
+  def failed(self):
+    return self.error is not None
+
+  def wait(self):
+    while not self._done.is_set():
+      self._done.wait(1.0)
+    return self.result
+
+  def _run(self):
+    try:
+      self.result = self.fn(*self.args, **self.kwargs)
+    except BaseException as e:
+      # SystemExit included: a task calling sys.exit should fail the task, not kill a worker silently
+      self.error = e
+      self.traceback = traceback.format_exc()
+      print('Error in %s: %s' % (self.name, e))
+      sys.stdout.flush()
+    finally:
+      self._done.set()
+
+
+class Scheduler(object):
+
+  def __init__(self, max_job_num=4):
+    assert max_job_num >= 1
+    self.max_job_num = max_job_num
+    self.tasks = []
+    self._queue = queue.Queue()
+    self._workers = []
+    self._unfinished = 0
+    self._cond = threading.Condition()
+
+  def submit(self, fn, *args, **kwargs):
+    """ queue fn(*args, **kwargs); returns its Task. Safe to call from inside a running task. """
+    name = kwargs.pop('task_name', None)
+    task = Task(fn, args, kwargs, name=name)
+    with self._cond:
+      self.tasks.append(task)
+      self._unfinished += 1
+      if len(self._workers) < self.max_job_num and len(self._workers) < self._unfinished:
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        self._workers.append(worker)
+        worker.start()
+    self._queue.put(task)
+    return task
+
+  def _work(self):
+    while True:
+      task = self._queue.get()
+      if task is None:
+        return
+      task._run()
+      with self._cond:
+        self._unfinished -= 1
+        if self._unfinished == 0:
+          self._cond.notify_all()
+
+  def join(self):
+    """ block until all submitted tasks are done; returns the list of tasks that failed """
+    with self._cond:
+      while self._unfinished > 0:
+        self._cond.wait(1.0)
+    return self.failed()
+
+  def failed(self):
+    return [t for t in self.tasks if t.failed()]
+
+  def shutdown(self):
+    """ stop the workers once the queue drains """
+    workers, self._workers = self._workers, []
+    for _ in workers:
+      self._queue.put(None)
+    for worker in workers:
+      worker.join()
@@ -7,6 +7,18 @@
 
 from .. import buildcommon as bc
 
+def get_split_class_idxs(params):
+    """ class ids to write as separate particles_selected_<k> outputs, or None when not splitting """
+    value = params.get('split_class_idxs')
+    if value is None or str(value).strip() == '':
+        return None
+    value = str(value).strip()
+    if value.lower() == 'all':
+        if params.get('split_num_classes') is None:
+            return []
+        return list(range(int(params['split_num_classes'])))
+    return sorted(set(int(v) for v in value.split(',') if v.strip() != ''))
+
 class builder(bc.builderbase):
     def initialize_params_and_inputs(job):
         """ required. all setup for this type """
@@ -23,11 +35,17 @@ class builder(bc.builderbase):
         job.param_add_section('general_settings', title='General Settings', desc='')
         job.param_add('general_settings', 'transpose_templates',            base_value=False,   title='Transpose templates',                                                param_type='boolean',   hidden=True,   advanced=True)
         job.param_add('general_settings', 'selected_templates',             base_value=None,    title='Selected templates (comma sep)',                                     param_type='string',    hidden=True,   advanced=True)
+        job.param_add('general_settings', 'map_particles',                  base_value=True,    title='Memory-map the particles instead of loading them',                param_type='boolean',   hidden=True,   advanced=True)
+        job.param_add('general_settings', 'profile_phases',                 base_value=False,   title='Write a cProfile dump of every phase to the job dir',              param_type='boolean',   hidden=True,   advanced=True)
         
         job.param_add_section('settings', title='Auto Thresholds', desc='Automatically apply thresholds and skip the interactive process')
         job.param_add('settings', 'class_idx',          base_value=None,    title='Specific class id',       param_type='number',    hidden=False,   advanced=False)
         job.param_add('settings', 'particle_count_above',            base_value=None,    title='Classes where particle count higher than',   param_type='number',    hidden=False,   advanced=False)
         job.param_add('settings', 'other_param',            base_value=None,    title='guess what',   param_type='number',    hidden=False,   advanced=True)
+
+        job.param_add_section('split_settings', title='Split Classes', desc='Write one particle output per class from a single load of the dataset')
+        job.param_add('split_settings', 'split_class_idxs',  base_value=None,    title='Split class ids (comma sep, or all)',     param_type='string',    hidden=False,   advanced=False)
+        job.param_add('split_settings', 'split_num_classes', base_value=None,    title='Number of classes (required for all)',    param_type='number',    hidden=False,   advanced=False)
       
 
     def validate_params(job, changes=None):
@@ -50,8 +68,16 @@ class builder(bc.builderbase):
         """ required. should have no side effects and should overwrite the outputs based on params and inputs """
         params = bc.com.get_merged_params(job)
         job.clear_outputs()
+        split_class_idxs = get_split_class_idxs(params)
 
-        if bc.com.is_input_slot_connected(job, 'particles', 'blob'):
+        if bc.com.is_input_slot_connected(job, 'particles', 'blob') and split_class_idxs is not None:
+            for class_idx in split_class_idxs:
+                group_name = 'particles_selected_%d' % class_idx
+                job.add_output_result_group(group_name, 'particle', title='Particles in class %d' % class_idx)
+                job.add_output_result('blob', group_name, 'particle.blob', title='Particle raw data')
+                job.add_output_result('alignments2D', group_name, 'particle.alignments2D', title='Particle 2D alignments')
+                job.passthrough_outputs(group_name, 'particles')
+        elif bc.com.is_input_slot_connected(job, 'particles', 'blob'):
             job.add_output_result_group('particles_selected', 'particle', title='Particles selected')
             job.add_output_result('blob', 'particles_selected', 'particle.blob', title='Particle raw data')
             job.add_output_result('alignments2D', 'particles_selected', 'particle.alignments2D', title='Particle 2D alignments')
@@ -59,7 +85,7 @@ class builder(bc.builderbase):
         job.add_output_result_group('templates_selected', 'template', title='Templates selected')
         job.add_output_result('blob', 'templates_selected', 'template.blob', title='Template raw data')
 
-        if bc.com.is_input_slot_connected(job, 'particles', 'blob'):
+        if bc.com.is_input_slot_connected(job, 'particles', 'blob') and split_class_idxs is None:
             job.add_output_result_group('particles_excluded', 'particle', title='Particles excluded')
             job.add_output_result('blob', 'particles_excluded', 'particle.blob', title='Particle raw data')
             job.add_output_result('alignments2D', 'particles_excluded', 'particle.alignments2D', title='Particle 2D alignments')
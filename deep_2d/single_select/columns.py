@@ -0,0 +1,135 @@
+## ---------------------------------------------------------------------------
+##    Copyright (c) 2019 Structura Biotechnology Inc. All rights reserved.
+##         Do not reproduce or redistribute, in whole or in part.
+##      Use of this code is permitted only under licence from Structura.
+##                   Contact us at info@structura.bio.
+## ---------------------------------------------------------------------------
+
+# Column-projected, memory-mapped input loading.
+#
+# rc.load_input_group reads every column of every slot into memory before the job does
+# anything. single_select only needs alignments2D/class, class_posterior and class_ess for
+# the whole stack; the other columns are needed for the rows being written out, and
+# cswriter copies those a chunk at a time. So the particles are memory-mapped instead:
+#
+#   dset = load_mapped(job, 'particles', ['blob', 'alignments2D'], proj_dir_abs, cli.get_job,
+#                      dense=['alignments2D/class', 'alignments2D/class_posterior'])
+#
+# finds the .cs file of each slot from the job's input connections and the output results
+# of the job they come from, and maps them (the .cs format is .npy). dset.data[name] is a
+# view into the file, so only the columns and rows that are used are ever read, and they
+# stay in the page cache rather than in the job's memory. Slots from different files are
+# joined on uid; a column of a file in another row order is then a TakenColumn, which only
+# supports indexing, so the columns listed in dense, which are read in full anyway, are
+# always plain arrays. When the files can't be worked out or mapped (several connections,
+# object columns), load_mapped returns None and the job loads the group as before.
+
+import os
+from collections import OrderedDict
+
+import numpy as n
+
+def slot_metafiles(job, group_name, slot_names, proj_dir_abs, get_job):
+    """ {slot name : absolute path of its .cs file} for an input group with one connection """
+    groups = [g for g in job['input_slot_groups'] if g['name'] == group_name]
+    if len(groups) != 1 or len(groups[0]['connections']) != 1:
+        return None
+    slots = dict((s['slot_name'], s) for s in groups[0]['connections'][0]['slots'])
+    parent_docs = {}
+    paths = OrderedDict()
+    for slot_name in slot_names:
+        slot = slots.get(slot_name)
+        if slot is None:
+            return None
+        if slot['job_uid'] not in parent_docs:
+            parent_docs[slot['job_uid']] = get_job(job['project_uid'], slot['job_uid'], 'output_results')
+        results = [r for r in parent_docs[slot['job_uid']]['output_results']
+                   if r['group_name'] == slot['group_name'] and r['name'] == slot['result_name']]
+        if len(results) != 1:
+            return None
+        version = slot.get('version', 'F')
+        metafiles = results[0]['metafiles']
+        path = metafiles[-1] if version == 'F' else metafiles[results[0]['versions'].index(version)]
+        paths[slot_name] = os.path.join(proj_dir_abs, path)
+    return paths
+
+class TakenColumn(object):
+    """ base[order], without making it: rows are only gathered when they are indexed """
+
+    def __init__(self, base, order):
+        self.base = base
+        self.order = order
+        self.dtype = base.dtype
+        self.shape = (len(order),) + base.shape[1:]
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, rows):
+        return self.base[self.order[rows]]
+
+    def __array__(self, dtype=None):
+        out = self.base[self.order]
+        return out if dtype is None else out.astype(dtype)
+
+class MappedDataset(object):
+    """ uid and the fields under slot_names, as views of memory-mapped .cs files, with rows in
+    the order of the first slot's file. Fields in dense are ndarrays even when they have to be joined. """
+
+    def __init__(self, paths, slot_names, dense=()):
+        mapped = {}
+        for path in set(paths.values()):
+            mapped[path] = n.load(path, mmap_mode='r')
+        first = mapped[paths[slot_names[0]]]
+        uid = first['uid']
+        self.data = OrderedDict([('uid', uid)])
+        orders = {}
+        for slot_name in slot_names:
+            path = paths[slot_name]
+            arr = mapped[path]
+            if arr is not first and path not in orders:
+                orders[path] = self._join(uid, arr['uid'], path)
+            for name in arr.dtype.names:
+                if name.split('/')[0] == slot_name:
+                    col = arr[name]
+                    if orders.get(path) is not None:
+                        col = TakenColumn(col, orders[path])
+                        if name in dense:
+                            col = n.asarray(col)
+                    self.data[name] = col
+
+    @staticmethod
+    def _join(uid, other_uid, path):
+        """ rows of other_uid in the order of uid, or None if they are in that order already """
+        if len(other_uid) == len(uid) and n.array_equal(other_uid, uid):
+            return None
+        sorter = n.argsort(other_uid)
+        found = n.searchsorted(other_uid, uid, sorter=sorter)
+        found[found == len(other_uid)] = 0
+        order = sorter[found]
+        if not n.array_equal(other_uid[order], uid):
+            raise ValueError('%s is missing particles of the other slots' % path)
+        return order
+
+    def __len__(self):
+        return len(self.data['uid'])
+
+    def fields(self):
+        return list(self.data.keys())
+
+def load_mapped(job, group_name, slot_names, proj_dir_abs, get_job, log=None, dense=()):
+    """ the input group as a MappedDataset, or None if it has to be loaded the usual way """
+    try:
+        paths = slot_metafiles(job, group_name, slot_names, proj_dir_abs, get_job)
+    except (KeyError, IndexError, TypeError, ValueError):
+        paths = None
+    if paths is None:
+        if log:
+            log('Could not find the .cs files of %s, loading it into memory' % group_name)
+        return None
+    try:
+        return MappedDataset(paths, list(slot_names), dense)
+    except (IOError, OSError, ValueError) as e:
+        if log:
+            log('Could not memory-map %s (%s), loading it into memory' % (group_name, e))
+        return None
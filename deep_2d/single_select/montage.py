@@ -0,0 +1,69 @@
+## ---------------------------------------------------------------------------
+##    Copyright (c) 2019 Structura Biotechnology Inc. All rights reserved.
+##         Do not reproduce or redistribute, in whole or in part.
+##      Use of this code is permitted only under licence from Structura.
+##                   Contact us at info@structura.bio.
+## ---------------------------------------------------------------------------
+
+# Class average montages from one rendering pass.
+#
+# Each class average is normalized into a thumbnail once. The log plot, group image and
+# tile image of a set are then tiled from those thumbnails and each drawn as a single
+# image on a single axes, instead of one figure with a subplot per class for every layout.
+
+import numpy as n
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+PAD = 2 # pixels between tiles
+
+def thumbnails(stack):
+    """ each image scaled to [0, 1] on its own range, like imshow's default per-image scaling """
+    stack = n.asarray(stack, dtype=n.float32)
+    if len(stack) == 0:
+        return stack
+    lo = stack.min(axis=(1,2), keepdims=True)
+    hi = stack.max(axis=(1,2), keepdims=True)
+    span = n.where(hi > lo, hi - lo, 1.0)
+    return (stack - lo) / span
+
+def tile(thumbs, rows, cols):
+    """ grid of the first rows*cols thumbnails, row major, on a white background """
+    ny, nx = thumbs.shape[1:]
+    grid = n.ones((rows * (ny + PAD) - PAD, cols * (nx + PAD) - PAD), dtype=n.float32)
+    for i, thumb in enumerate(thumbs[:rows * cols]):
+        r, c = divmod(i, cols)
+        grid[r*(ny+PAD):r*(ny+PAD)+ny, c*(nx+PAD):c*(nx+PAD)+nx] = thumb
+    return grid
+
+def figure(grid, rows, cols, figsize_each):
+    fig = Figure(figsize=(cols * figsize_each, rows * figsize_each))
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.imshow(grid, cmap='gray', vmin=0.0, vmax=1.0, interpolation='nearest')
+    ax.axis('off')
+    return fig
+
+def layouts(num_classes):
+    """ (rows, cols, figsize_each) of the log plot, group image and tile image """
+    return {
+        'log' : (max(1, int(n.ceil(num_classes / 10.0))), 10, 1.0),
+        'group' : (3, 3, 0.6),
+        'tile' : (3, 6, 0.6),
+    }
+
+def render_grids(stack):
+    """ thumbnails once, then every layout's grid from them """
+    thumbs = thumbnails(stack)
+    return { name : tile(thumbs, rows, cols) for name, (rows, cols, _) in layouts(len(thumbs)).items() }
+
+def render_sets(stacks):
+    """ figures for each non-empty stack: a list of {'log','group','tile'} -> Figure (None for empty stacks) """
+    out = [None] * len(stacks)
+    for i, stack in enumerate(stacks):
+        if len(stack) > 0:
+            grids = render_grids(stack)
+            out[i] = { name : figure(grids[name], rows, cols, figsize_each)
+                       for name, (rows, cols, figsize_each) in layouts(len(stack)).items() }
+    return out
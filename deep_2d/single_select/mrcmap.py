@@ -0,0 +1,100 @@
+## ---------------------------------------------------------------------------
+##    Copyright (c) 2019 Structura Biotechnology Inc. All rights reserved.
+##         Do not reproduce or redistribute, in whole or in part.
+##      Use of this code is permitted only under licence from Structura.
+##                   Contact us at info@structura.bio.
+## ---------------------------------------------------------------------------
+
+# Memory-mapped access to MRC stacks, so only the slices that are used get read.
+
+import struct
+import threading
+import numpy as n
+
+from ...blobio import mrc
+
+MRC_DTYPES = {
+    0 : n.dtype('<i1'),
+    1 : n.dtype('<i2'),
+    2 : n.dtype('<f4'),
+    6 : n.dtype('<u2'),
+    12 : n.dtype('<f2'),
+}
+
+_memmaps = {}
+_memmaps_lock = threading.Lock()
+
+def read_mrc_header(path_abs):
+    with open(path_abs, 'rb') as f:
+        header = f.read(1024)
+    nx, ny, nz, mode = struct.unpack('<4i', header[0:16])
+    nsymbt, = struct.unpack('<i', header[92:96])
+    return {'nx' : nx, 'ny' : ny, 'nz' : nz, 'mode' : mode, 'nsymbt' : nsymbt}
+
+def memmap_mrc(path_abs):
+    """ read-only (nz, ny, nx) memmap of an MRC file, or None if its data mode is not supported. Cached per path. """
+    with _memmaps_lock:
+        if path_abs not in _memmaps:
+            hdr = read_mrc_header(path_abs)
+            if hdr['mode'] not in MRC_DTYPES:
+                _memmaps[path_abs] = None
+            else:
+                _memmaps[path_abs] = n.memmap(path_abs, dtype=MRC_DTYPES[hdr['mode']], mode='r',
+                                              offset=1024 + hdr['nsymbt'], shape=(hdr['nz'], hdr['ny'], hdr['nx']))
+        return _memmaps[path_abs]
+
+def read_slices(path_abs, idxs):
+    """ float32 copy of the given slices of an MRC stack """
+    mm = memmap_mrc(path_abs)
+    if mm is None:
+        _, data = mrc.read_mrc(path_abs)
+        return n.asarray(data[idxs], dtype=n.float32)
+    return n.asarray(mm[idxs], dtype=n.float32)
+
+class TemplateStack(object):
+    """ Lazy stack of class averages that may be spread over several MRC files.
+
+    Row i is slice idxs[i] of paths_abs[i]. Indexing reads only the requested rows.
+    With transpose=True the stack is reinterpreted in F order, like
+    stack.ravel().reshape(stack.shape, order='F'); that mixes pixels across rows, so the
+    selected rows are read once and reinterpreted as a view, without another copy. """
+
+    def __init__(self, paths_abs, idxs, transpose=False):
+        self.paths_abs = [str(p) for p in paths_abs]
+        self.idxs = n.asarray(idxs, dtype=n.int64)
+        self.transpose = transpose
+        self._transposed = None
+        if len(self.idxs) > 0:
+            hdr = read_mrc_header(self.paths_abs[0])
+            self.shape = (len(self.idxs), hdr['ny'], hdr['nx'])
+        else:
+            self.shape = (0, 0, 0)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_rows(self, rows):
+        out = n.empty((len(rows),) + self.shape[1:], dtype=n.float32)
+        paths = n.array(self.paths_abs)[rows] if len(rows) > 0 else []
+        for path_abs in set(paths):
+            which = n.where(paths == path_abs)[0]
+            slice_idxs = self.idxs[rows[which]]
+            # read in file order, then put back in the requested order
+            file_order = n.argsort(slice_idxs, kind='mergesort')
+            out[which[file_order]] = read_slices(path_abs, slice_idxs[file_order])
+        return out
+
+    def __getitem__(self, key):
+        if self.transpose:
+            if self._transposed is None:
+                stack = self._read_rows(n.arange(len(self)))
+                self._transposed = stack.ravel().reshape(stack.shape, order='F')
+            return self._transposed[key]
+        rows = n.arange(len(self))[key]
+        if n.ndim(rows) == 0:
+            return self._read_rows(n.array([rows]))[0]
+        return self._read_rows(rows)
+
+    def __array__(self, dtype=None):
+        stack = self[:]
+        return stack if dtype is None else stack.astype(dtype)
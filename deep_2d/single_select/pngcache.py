@@ -0,0 +1,78 @@
+## ---------------------------------------------------------------------------
+##    Copyright (c) 2019 Structura Biotechnology Inc. All rights reserved.
+##         Do not reproduce or redistribute, in whole or in part.
+##      Use of this code is permitted only under licence from Structura.
+##                   Contact us at info@structura.bio.
+## ---------------------------------------------------------------------------
+
+# On-disk cache of rendered class average PNGs, keyed by a hash of the image content.
+#
+# Sibling single_select jobs reading the same class_2D output render each class once
+# between them, and reuse the file id of an earlier upload in the same project
+# instead of uploading the same image again.
+
+import os
+import io
+import json
+import hashlib
+import numpy as n
+
+from .. import runcommon as rc
+from ... import plotutil
+
+RENDER_VERSION = 1 # bump when the rendering changes, so old entries are not reused
+
+def image_key(img):
+    img = n.ascontiguousarray(img, dtype=n.float32)
+    h = hashlib.sha1()
+    h.update(('v%d %s' % (RENDER_VERSION, img.shape)).encode('utf-8'))
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+def _write_atomic(path, data):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+def render_class_images(template_mrc, cache_dir):
+    """ PNG bytes of each class average in template_mrc, rendering only those not in the cache """
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass # created by a sibling job in the meantime
+    stack = template_mrc[:]
+    keys = [image_key(img) for img in stack]
+    pngs = [None] * len(keys)
+    for index, key in enumerate(keys):
+        png_path = os.path.join(cache_dir, key + '.png')
+        if os.path.exists(png_path):
+            with open(png_path, 'rb') as f:
+                pngs[index] = f.read()
+    missing = [index for index, png in enumerate(pngs) if png is None]
+    if len(missing) > 0:
+        rendered = plotutil.plot_2D_classes_return_images(stack[missing])
+        for index, img_io in zip(missing, rendered):
+            pngs[index] = img_io.getvalue()
+            _write_atomic(os.path.join(cache_dir, keys[index] + '.png'), pngs[index])
+    return keys, pngs
+
+def upload_class_images(template_mrc, template_classes, cache_dir, project_uid):
+    """ file id of the uploaded PNG of every class, keyed by class_idx. Uploads only images this project has not seen. """
+    keys, pngs = render_class_images(template_mrc, cache_dir)
+    fileids = {}
+    num_uploaded = 0
+    for key, png, class_idx in zip(keys, pngs, template_classes):
+        meta_path = os.path.join(cache_dir, '%s.%s.json' % (key, project_uid))
+        fileid = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                fileid = json.load(f).get('fileid')
+        if fileid is None:
+            fileid = str(rc.upload_file(io.BytesIO(png), filename="class2D_%d.png" % class_idx))
+            _write_atomic(meta_path, json.dumps({'fileid' : fileid}).encode('utf-8'))
+            num_uploaded += 1
+        fileids[class_idx] = fileid
+    rc.log('Class images: %d uploaded, %d reused from cache' % (num_uploaded, len(keys) - num_uploaded))
+    return fileids
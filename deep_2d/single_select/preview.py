@@ -0,0 +1,67 @@
+## ---------------------------------------------------------------------------
+##    Copyright (c) 2019 Structura Biotechnology Inc. All rights reserved.
+##         Do not reproduce or redistribute, in whole or in part.
+##      Use of this code is permitted only under licence from Structura.
+##                   Contact us at info@structura.bio.
+## ---------------------------------------------------------------------------
+
+# Particle previews for the selected / excluded output group images.
+#
+# Preview particles are sampled round-robin across classes, so the 3x3 image shows
+# what went into a group rather than the first nine particles of one micrograph.
+# Both previews are read in one batch, grouped by source MRC file and read through
+# the memory-mapped reader in file order.
+
+import os
+import numpy as n
+
+from . import mrcmap
+
+def _str(path):
+    return path if isinstance(path, str) else path.decode('utf-8')
+
+def sample_rows(positions, mask, num=9, seed=0):
+    """ up to num rows where mask is True, taking one particle per class in turn """
+    rows = n.where(mask)[0]
+    if len(rows) <= num:
+        return rows
+    rng = n.random.RandomState(seed)
+    # a random pool of candidates is enough to cover the classes, without permuting all rows
+    candidates = n.unique(rows[rng.randint(0, len(rows), min(len(rows), num * 64))])
+    rng.shuffle(candidates)
+    by_class = {}
+    for row in candidates:
+        by_class.setdefault(positions[row], []).append(row)
+    queues = [by_class[k] for k in sorted(by_class.keys())]
+    picked = []
+    while len(picked) < num and any(queues):
+        for queue in queues:
+            if queue and len(picked) < num:
+                picked.append(queue.pop())
+    return n.array(picked, dtype=n.int64)
+
+def read_frames(dset, rows, proj_dir_abs):
+    """ particle images of the given rows, in the order given, reading each source file once """
+    rows = n.asarray(rows, dtype=n.int64)
+    paths = dset.data['blob/path'][rows]
+    idxs = n.asarray(dset.data['blob/idx'][rows], dtype=n.int64)
+    frames = [None] * len(rows)
+    for path in set(paths):
+        which = n.where(paths == path)[0]
+        file_order = which[n.argsort(idxs[which], kind='mergesort')]
+        data = mrcmap.read_slices(os.path.join(proj_dir_abs, _str(path)), idxs[file_order])
+        for j, w in enumerate(file_order):
+            frames[w] = data[j]
+    return frames
+
+def read_previews(dset, positions, masks, proj_dir_abs, num=9):
+    """ preview images for each mask in masks, from one batched read """
+    samples = [sample_rows(positions, mask, num) for mask in masks]
+    all_rows = n.concatenate(samples) if len(samples) > 0 else n.array([], dtype=n.int64)
+    frames = read_frames(dset, all_rows, proj_dir_abs)
+    out = []
+    start = 0
+    for rows in samples:
+        out.append(frames[start:start+len(rows)])
+        start += len(rows)
+    return out
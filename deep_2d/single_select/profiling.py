@@ -0,0 +1,134 @@
+## ---------------------------------------------------------------------------
+##    Copyright (c) 2019 Structura Biotechnology Inc. All rights reserved.
+##         Do not reproduce or redistribute, in whole or in part.
+##      Use of this code is permitted only under licence from Structura.
+##                   Contact us at info@structura.bio.
+## ---------------------------------------------------------------------------
+
+# Per-phase wall time and memory of a job run.
+#
+#   timer = PhaseTimer(rc.log, os.path.join(job_dir_abs, 'single_select_metrics.json'))
+#   with timer.phase('load particles'):
+#       ...
+#   timer.log_summary()
+#
+# Every phase logs its wall time and peak RSS, and the metrics file in the job dir is
+# rewritten after each phase, so a job that dies still leaves the phases it finished.
+# The peak is sampled from /proc/self/statm by a background thread while a phase runs
+# (ru_maxrss only knows the peak of the whole process); when the process peak rises
+# during a phase, that new peak belongs to the phase too, which catches spikes shorter
+# than the sampling interval. Where /proc is missing, the process peak so far is reported.
+#
+# With profile_dir set, each phase also runs under cProfile and is dumped to
+# <profile_dir>/profile_<phase>.prof, for `python -m pstats` or snakeviz.
+
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+
+_STATM = '/proc/self/statm'
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def current_rss():
+    """ resident set size of this process in bytes, or None where /proc is missing """
+    try:
+        with open(_STATM) as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+def process_peak_rss():
+    """ peak resident set size of this process so far, in bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname()[0] == 'Darwin' else peak * 1024
+
+class _MemorySampler(threading.Thread):
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = current_rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        rss = current_rss()
+        if rss is not None and self.peak is not None:
+            self.peak = max(self.peak, rss)
+        return self.peak
+
+class PhaseTimer(object):
+
+    def __init__(self, log=None, metrics_path=None, profile_dir=None, sample_interval=0.05):
+        self.log = log
+        self.metrics_path = metrics_path
+        self.profile_dir = profile_dir
+        self.sample_interval = sample_interval
+        self.phases = []
+        self.t0 = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        sampler = _MemorySampler(self.sample_interval)
+        sampler.start()
+        profiler = None
+        if self.profile_dir is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        peak_before = process_peak_rss()
+        tic = time.time()
+        try:
+            yield
+        finally:
+            wall = time.time() - tic
+            if profiler is not None:
+                profiler.disable()
+            peak = sampler.stop()
+            peak_after = process_peak_rss()
+            if peak is None or peak_after > peak_before:
+                peak = max(peak or 0, peak_after)
+            record = {'phase': name, 'start_s': tic - self.t0, 'wall_s': wall,
+                      'peak_rss_mb': peak / 1024.0 / 1024.0,
+                      'end_rss_mb': (current_rss() or 0) / 1024.0 / 1024.0}
+            if profiler is not None:
+                record['profile'] = os.path.join(self.profile_dir, 'profile_%s.prof' % name.replace(' ', '_'))
+                profiler.dump_stats(record['profile'])
+            self.phases.append(record)
+            if self.log is not None:
+                self.log('Phase %s : %.2f s, peak RSS %.0f MB' % (name, wall, record['peak_rss_mb']))
+            self.write()
+
+    def metrics(self):
+        return {'total_s': time.time() - self.t0,
+                'process_peak_rss_mb': process_peak_rss() / 1024.0 / 1024.0,
+                'phases': self.phases}
+
+    def write(self):
+        if self.metrics_path is None:
+            return
+        tmp_path = self.metrics_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.metrics(), f, indent=2)
+        os.rename(tmp_path, self.metrics_path)
+
+    def log_summary(self):
+        if self.log is None or len(self.phases) == 0:
+            return
+        metrics = self.metrics()
+        lines = ['%-24s %9s %14s' % ('phase', 'wall (s)', 'peak RSS (MB)')]
+        lines += ['%-24s %9.2f %14.0f' % (p['phase'], p['wall_s'], p['peak_rss_mb']) for p in self.phases]
+        lines += ['%-24s %9.2f %14.0f' % ('total', metrics['total_s'], metrics['process_peak_rss_mb'])]
+        self.log('\n'.join(lines))
+        self.write()
@@ -0,0 +1,103 @@
+## ---------------------------------------------------------------------------
+##    Copyright (c) 2019 Structura Biotechnology Inc. All rights reserved.
+##         Do not reproduce or redistribute, in whole or in part.
+##      Use of this code is permitted only under licence from Structura.
+##                   Contact us at info@structura.bio.
+## ---------------------------------------------------------------------------
+
+# Response bodies of the interactive endpoints.
+#
+#   dumps(res)                 json, numpy scalars and arrays as plain numbers and lists
+#   dumps(res, compact=True)   arrays as {'__ndarray__': base64, 'dtype': '<f8', 'shape': [100]}
+#                              instead: the little-endian bytes, about a third of the json text
+#   gzip_bytes(body)           for clients that send Accept-Encoding: gzip
+#   BodyCache                  finished bodies by ETag, so an unchanged answer (histograms,
+#                              the class list between changes) is serialized and compressed once
+
+import io
+import json
+import gzip
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as n
+
+MIN_GZIP_BYTES = 1024 # smaller bodies are not worth a compression round trip
+
+class NumpyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, n.integer):
+            return int(obj)
+        elif isinstance(obj, n.floating):
+            if not n.isfinite(obj):
+                return float(0.0)
+            return float(obj)
+        elif isinstance(obj, n.ndarray):
+            return obj.tolist()
+        else:
+            return super(NumpyEncoder, self).default(obj)
+
+class CompactNumpyEncoder(NumpyEncoder):
+    def default(self, obj):
+        if isinstance(obj, n.ndarray) and obj.dtype.kind in 'biuf':
+            data = n.ascontiguousarray(obj, dtype=obj.dtype.newbyteorder('<'))
+            return {'__ndarray__' : base64.b64encode(data.tobytes()).decode('ascii'),
+                    'dtype' : data.dtype.str,
+                    'shape' : list(data.shape)}
+        return super(CompactNumpyEncoder, self).default(obj)
+
+def dumps(res, compact=False):
+    return json.dumps(res, cls=CompactNumpyEncoder if compact else NumpyEncoder).encode('utf-8')
+
+def accepts_gzip(accept_encoding):
+    return any(part.split(';')[0].strip() == 'gzip' for part in accept_encoding.split(','))
+
+def gzip_bytes(body, level=5):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(body)
+    return buf.getvalue()
+
+def gzip_body(body):
+    """ the gzip of a response body, or None if it is too small to bother """
+    if len(body) < MIN_GZIP_BYTES:
+        return None
+    return gzip_bytes(body)
+
+def etag(name, version, kwargs, compact):
+    """ names one answer of one endpoint: the endpoint, the state version, the arguments and the encoding """
+    args = hashlib.md5(json.dumps(kwargs, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return '%s-%d-%s%s' % (name, version, args, '-c' if compact else '')
+
+class BodyCache(object):
+    """ the json body, and its gzip when asked for, of the last max_entries answers by ETag """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def body(self, tag, make_body):
+        """ the json body for tag; make_body() is only called when the tag isn't cached """
+        with self.lock:
+            entry = self.entries.pop(tag, None)
+            if entry is None:
+                entry = [make_body(), None]
+            self.entries[tag] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return entry[0]
+
+    def gzipped(self, tag, body):
+        """ gzip_body(body) of the answer for tag, compressed once """
+        with self.lock:
+            entry = self.entries.get(tag)
+            if entry is not None and entry[1] is not None:
+                return entry[1]
+        compressed = gzip_body(body)
+        with self.lock:
+            if compressed is not None and tag in self.entries:
+                self.entries[tag][1] = compressed
+        return compressed
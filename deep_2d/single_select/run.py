@@ -9,12 +9,13 @@
 # interactive job
 #   threaded so each request can do blocking IO or compute as needed
 #   number of concurrent requests should be small enough that 1 thread per request is okay
+#   every endpoint reads and changes state under locks['state'], so requests see and leave
+#   the selection, the threshold and the counts consistent with each other
 #
 
 from builtins import str
 import os, sys
-from flask import Flask, request
-import json
+from flask import Flask, request, Response
 import datetime
 import logging
 
@@ -22,7 +23,7 @@ import socket
 from threading import RLock
 
 app = Flask('single_select')
-locks = {'test' : RLock() }
+locks = {'test' : RLock(), 'state' : RLock() }
 
 # This disables logging for every HTTP request.
 # Flask will still automatically log when there are errors, but JSONRPC won't.
@@ -32,35 +33,66 @@ log.setLevel(logging.ERROR)
 import numpy as n
 from .. import runcommon as rc
 
-from ...blobio import mrc
 from ... import plotutil
 
-from ... import particles
+from .build import get_split_class_idxs
+from . import selection
+from . import mrcmap
+from . import pngcache
+from . import montage
+from . import cswriter
+from . import preview
+from .profiling import PhaseTimer
+from . import responses
+from . import columns
+from .responses import NumpyEncoder
 
 cli = rc.cli
 _job = None
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, n.integer):
-            return int(obj)
-        elif isinstance(obj, n.floating):
-            if not n.isfinite(obj):
-                return float(0.0)
-            return float(obj)
-        elif isinstance(obj, n.ndarray):
-            return obj.tolist()
-        else:
-            return super(NumpyEncoder, self).default(obj)
+# Every change to the selection bumps state['version']. Responses carry it in X-State-Version,
+# and queries (answers that only depend on the version and the arguments) get a weak ETag:
+# a client that sends it back in If-None-Match gets 304 Not Modified until something changes.
+# Bodies are gzipped for clients that accept it, and with X-Array-Encoding: base64 numpy
+# arrays are sent as base64 of their bytes instead of json lists (see responses.py).
+body_cache = responses.BodyCache()
 
-def extern(func):
+def extern(func, query=False):
     def wrapper(*args, **kwargs):
         kwargs.update(request.get_json(force=True))
-        res = func(*args, **kwargs)
-        return json.dumps(res, cls=NumpyEncoder)
+        compact = request.headers.get('X-Array-Encoding') == 'base64'
+        use_gzip = responses.accepts_gzip(request.headers.get('Accept-Encoding', ''))
+        tag = body = None
+        with locks['state']:
+            version = state.get('version', 0)
+            if query:
+                tag = responses.etag(func.__name__, version, kwargs, compact)
+                if not request.if_none_match.contains_weak(tag):
+                    body = body_cache.body(tag, lambda: responses.dumps(func(*args, **kwargs), compact))
+            else:
+                body = responses.dumps(func(*args, **kwargs), compact)
+                version = state.get('version', 0)
+        # compressed outside the lock
+        compressed = None
+        if body is not None and use_gzip:
+            compressed = body_cache.gzipped(tag, body) if query else responses.gzip_body(body)
+        if body is None:
+            res = Response(status=304)
+        else:
+            res = Response(compressed if compressed is not None else body, mimetype='application/json')
+        if compressed is not None:
+            res.headers['Content-Encoding'] = 'gzip'
+        if tag is not None:
+            res.set_etag(tag, weak=True)
+        res.headers['Vary'] = 'Accept-Encoding, X-Array-Encoding'
+        res.headers['X-State-Version'] = str(version)
+        return res
     wrapper.__name__ = func.__name__
     return app.route('/'+func.__name__, methods=['POST'])(wrapper)
 
+def extern_query(func):
+    return extern(func, query=True)
+
 # ============================================================================
 
 state = {}
@@ -87,67 +119,123 @@ def run(job):
 
     # load params
     params = rc.com.get_merged_params(job)
+
+    # wall time and peak memory of every phase, logged and written to the job dir
+    timer = PhaseTimer(rc.log, os.path.join(job_dir_abs, 'single_select_metrics.json'),
+                       profile_dir=job_dir_abs if params['profile_phases'] else None)
     
     # load inputs
-    templates_dset = rc.load_input_group(input_group_name='templates', slot_names=['blob']) 
-    rc.log('Loaded info for %d classes ' % (len(templates_dset)))
-    template_classes = templates_dset.data['blob/idx']
+    with timer.phase('load templates'):
+        templates_dset = rc.load_input_group(input_group_name='templates', slot_names=['blob']) 
+        rc.log('Loaded info for %d classes ' % (len(templates_dset)))
+        template_classes = templates_dset.data['blob/idx']
     
     has_particles = rc.com.is_input_slot_connected(job, 'particles', 'blob')
     if has_particles:
-        particles_dset = rc.load_input_group(input_group_name='particles', slot_names=['blob', 'alignments2D']) 
-        num_particles = len(particles_dset)
-        rc.log('Loaded info for %d particles' % (num_particles))
-        class_assignments = particles_dset.data['alignments2D/class']
-
-    all_mrcs = list(set(templates_dset.data['blob/path']))
-    assert len(all_mrcs) == 1, "Templates in multiple MRC not supported yet"
-    mrc_path_abs = os.path.join(proj_dir_abs, all_mrcs[0])
-    _, template_mrc = mrc.read_mrc(mrc_path_abs)
-    template_mrc = template_mrc[templates_dset.data['blob/idx']] # slice out only the indicated ones
-    
-    if params['transpose_templates']:
-        # go back to C order from accidental F-order
-        template_mrc = template_mrc.ravel().reshape(template_mrc.shape, order='F')
+        with timer.phase('load particles'):
+            # memory-mapped: only the class columns are read in full, the rest when outputs are written
+            particles_dset = None
+            if params['map_particles']:
+                particles_dset = columns.load_mapped(job, 'particles', ['blob', 'alignments2D'], proj_dir_abs, cli.get_job, rc.log,
+                                                     dense=['alignments2D/class', 'alignments2D/class_posterior', 'alignments2D/class_ess'])
+            if particles_dset is None:
+                particles_dset = rc.load_input_group(input_group_name='particles', slot_names=['blob', 'alignments2D']) 
+            num_particles = len(particles_dset)
+            rc.log('Loaded info for %d particles%s' % (num_particles, ' (memory-mapped)' if isinstance(particles_dset, columns.MappedDataset) else ''))
+            class_assignments = particles_dset.data['alignments2D/class']
+
+    # lazy, memory-mapped stack: only the class averages that are used get read, from any number of MRC files
+    template_mrc = mrcmap.TemplateStack([os.path.join(proj_dir_abs, p) for p in templates_dset.data['blob/path']],
+                                        templates_dset.data['blob/idx'],
+                                        transpose=params['transpose_templates'])
     
-    # upload all images of templates ahead of time
-    template_imgs_stringio = plotutil.plot_2D_classes_return_images(template_mrc)
-    template_imgs_fileid = { class_idx : str(rc.upload_file(template_imgs_stringio[index], filename="class2D_%d.png" % class_idx)) for index, class_idx in enumerate(template_classes) }
-
-    if has_particles:
-        class_info = [ {
-            'class_idx' : class_idx,
-            'fileid' : template_imgs_fileid[class_idx],
-            'selected' : False,
-            'num_particles_total' : n.sum(class_assignments==class_idx),
-            'num_particles_selected' : 0,
-            'res_A' : templates_dset.data['blob/res_A'][index],
-            'mean_prob' : n.mean(particles_dset.data['alignments2D/class_posterior'][class_assignments==class_idx]),
-            'class_ess' : n.mean(particles_dset.data['alignments2D/class_ess'][class_assignments==class_idx])
-            } 
-        for index, class_idx in enumerate(template_classes) ]
-        prob_thresh = 0.0 # default to taking all matches
-        prob_hist_data, prob_hist_bins = n.histogram(particles_dset.data['alignments2D/class_posterior'], 100, range=(0,1))
-        prob_sum_data = num_particles - n.cumsum(prob_hist_data)
-    else:
-        class_info = [ {
-            'class_idx' : class_idx,
-            'fileid' : template_imgs_fileid[class_idx],
-            'selected' : False,
-            'num_particles_total' : 0,
-            'num_particles_selected' : 0,
-            'res_A' : templates_dset.data['blob/res_A'][index],
-            'mean_prob' : 1,
-            'class_ess' : 0
-            } 
-        for index, class_idx in enumerate(template_classes) ]
-
-    state.update(locals())
-
     has_res_threshold = params['class_idx'] is not None
     has_count_threshold = params['particle_count_above'] is not None
+    split_class_idxs = get_split_class_idxs(params)
+    interactive = split_class_idxs is None and not params['selected_templates'] and not (has_res_threshold or has_count_threshold)
+
+    if interactive:
+        # upload all images of templates ahead of time, for the selection UI only
+        cache_dir = os.path.join(proj_dir_abs, 'single_select_cache')
+        with timer.phase('upload images'):
+            template_imgs_fileid = pngcache.upload_class_images(template_mrc, template_classes, cache_dir, puid)
+    else:
+        template_imgs_fileid = { class_idx : None for class_idx in template_classes }
+
+    with timer.phase('class statistics'):
+        if has_particles:
+            # one pass over the particles for all per-class statistics
+            num_classes = len(template_classes)
+            class_positions = selection.class_positions(class_assignments, template_classes)
+            class_counts = selection.per_class_counts(class_positions, num_classes)
+            class_mean_prob = selection.per_class_means(class_positions, num_classes, particles_dset.data['alignments2D/class_posterior'], class_counts)
+            class_mean_ess = selection.per_class_means(class_positions, num_classes, particles_dset.data['alignments2D/class_ess'], class_counts)
+            class_info = [ {
+                'class_idx' : class_idx,
+                'fileid' : template_imgs_fileid[class_idx],
+                'selected' : False,
+                'num_particles_total' : class_counts[index],
+                'num_particles_selected' : 0,
+                'res_A' : templates_dset.data['blob/res_A'][index],
+                'mean_prob' : class_mean_prob[index],
+                'class_ess' : class_mean_ess[index]
+                } 
+            for index, class_idx in enumerate(template_classes) ]
+            prob_thresh = 0.0 # default to taking all matches
+            # built once so threshold changes are lookups instead of rescans of all particles
+            posterior_index = selection.ClassPosteriorIndex(class_positions, num_classes, particles_dset.data['alignments2D/class_posterior'])
+            prob_hist_data, prob_hist_bins = n.histogram(particles_dset.data['alignments2D/class_posterior'], 100, range=(0,1))
+            prob_sum_data = num_particles - n.cumsum(prob_hist_data)
+        else:
+            class_info = [ {
+                'class_idx' : class_idx,
+                'fileid' : template_imgs_fileid[class_idx],
+                'selected' : False,
+                'num_particles_total' : 0,
+                'num_particles_selected' : 0,
+                'res_A' : templates_dset.data['blob/res_A'][index],
+                'mean_prob' : 1,
+                'class_ess' : 0
+                } 
+            for index, class_idx in enumerate(template_classes) ]
+            prob_thresh = 0.0 # no particles to threshold, but the selection endpoints keep it
+
+    class_position = { class_idx : index for index, class_idx in enumerate(template_classes) }
+    # the version each class last changed at, and what it was then, for delta get_class_info
+    version = 0
+    class_versions = n.zeros(len(class_info), dtype=n.int64)
+    class_marks = [(class_dict['selected'], class_dict['num_particles_selected']) for class_dict in class_info]
+    state.update(locals())
 
-    if params['selected_templates']:
+    if split_class_idxs is not None:
+        # one load, one output group per class. Classes with too few particles get no output.
+        cli.set_job_status(job['project_uid'], job['uid'], 'running')
+        assert has_particles, "Splitting classes needs particles connected"
+        assert len(split_class_idxs) > 0, "Set the number of classes to split all classes"
+        rc.log('Splitting particles into %d classes' % (len(split_class_idxs)))
+        with timer.phase('split output'):
+            class_posterior = particles_dset.data['alignments2D/class_posterior']
+            class_order, class_offsets = selection.class_members(class_positions, num_classes)
+            for class_idx in split_class_idxs:
+                if class_idx not in class_position:
+                    rc.log('Class %d is not in the templates, skipping' % class_idx)
+                    continue
+                index = class_position[class_idx]
+                class_dict = class_info[index]
+                if has_count_threshold and class_dict['num_particles_total'] <= params['particle_count_above']:
+                    continue
+                split_idxs = class_order[class_offsets[index]:class_offsets[index+1]] # stable sort, still in dataset order
+                split_idxs = split_idxs[class_posterior[split_idxs] > prob_thresh]
+                if len(split_idxs) == 0:
+                    continue
+                class_dict['selected'] = True
+                group_name = 'particles_selected_%d' % class_idx
+                outpath_rel = os.path.join(job_dir_rel, group_name + '.cs')
+                cswriter.write_rows(particles_dset, split_idxs, os.path.join(proj_dir_abs, outpath_rel), ['blob', 'alignments2D'])
+                rc.output(group_name, 'blob', outpath_rel, 0, len(split_idxs))
+                rc.output(group_name, 'alignments2D', outpath_rel, 0, len(split_idxs))
+                rc.log('Class %d : %d particles' % (class_idx, len(split_idxs)))
+    elif params['selected_templates']:
         cli.set_job_status(job['project_uid'], job['uid'], 'running')
         selected_idxs = [int(v) for v in params['selected_templates'].strip().split(',')]
         for temp in class_info:
@@ -161,13 +249,15 @@ def run(job):
                 rc.log(class_dict)
                 if (class_dict['class_idx']==params['class_idx']) and (class_dict['num_particles_total'] > params['particle_count_above']) :
                     class_dict['selected']=True
-    '''
     else:
         rc.log('Interactive job running on port %d' % port)
         cli.set_job_status(job['project_uid'], job['uid'], 'waiting')
-        app.run(host="0.0.0.0", port=port, threaded=False)
+        app.run(host="0.0.0.0", port=port, threaded=True)
         cli.set_job_status(job['project_uid'], job['uid'], 'running')
-    '''    
+        # the threshold the user ended with, not the one the job started with
+        with locks['state']:
+            prob_thresh = state['prob_thresh']
+    
     
     rc.log('Outputting selection..')
     # Finish and make outputs code
@@ -180,83 +270,68 @@ def run(job):
     rc.log('Templates selected : %d' % (len(templates_dset_include)))
     rc.log('Templates excluded : %d' % (len(templates_dset_exclude)))
 
+    # one rendering pass per set, the log, group and tile images are all built from it
+    with timer.phase('render templates'):
+        templates_include_figs, templates_exclude_figs = montage.render_sets([template_mrc[templates_include_idx], template_mrc[templates_exclude_idx]])
+
     if len(templates_include_idx) > 0:
         outpath_rel = os.path.join(job_dir_rel, 'templates_selected.cs')
         templates_dset_include.filter_prefix('blob').to_file(os.path.join(proj_dir_abs, outpath_rel))
         rc.output('templates_selected', 'blob', outpath_rel, 0, len(templates_dset_include))
         
-        fig = plotutil.plot_2D_classes(template_mrc[templates_include_idx],
-                                    rows = int(n.ceil(len(templates_include_idx) / 10.0)), cols = 10,
-                                    figsize_each=1.0)
-        rc.log_plot(fig, 'Selected %d classes:' % len(templates_include_idx))
-
-        figgroup = plotutil.plot_2D_classes(template_mrc[templates_include_idx],
-                                    rows = 3, cols = 3,
-                                    figsize_each=0.6)
-        rc.set_output_group_image('templates_selected', figgroup)
-        
-        figtile = plotutil.plot_2D_classes(template_mrc[templates_include_idx],
-                                    rows = 3, cols = 6,
-                                    figsize_each=0.6)
+        rc.log_plot(templates_include_figs['log'], 'Selected %d classes:' % len(templates_include_idx))
+        rc.set_output_group_image('templates_selected', templates_include_figs['group'])
         
-        if len(template_mrc[templates_include_idx]) == 1:                            
-            rc.set_tile_image('templates_selected', figtile, 1, 1)
+        if len(templates_include_idx) == 1:                            
+            rc.set_tile_image('templates_selected', templates_include_figs['tile'], 1, 1)
         else:
-            rc.set_tile_image('templates_selected', figtile, 1, 2)
+            rc.set_tile_image('templates_selected', templates_include_figs['tile'], 1, 2)
 
     if len(templates_exclude_idx) > 0:
         outpath_rel = os.path.join(job_dir_rel, 'templates_excluded.cs')
         templates_dset_exclude.filter_prefix('blob').to_file(os.path.join(proj_dir_abs, outpath_rel))
         rc.output('templates_excluded', 'blob', outpath_rel, 0, len(templates_dset_exclude))
         
-        fig = plotutil.plot_2D_classes(template_mrc[templates_exclude_idx],
-                                        rows = int(n.ceil(len(templates_exclude_idx) / 10.0)), cols = 10,
-                                        figsize_each=1.0)
-        rc.log_plot(fig, 'Excluded %d classes:' % len(templates_exclude_idx))
-
-        figgroup = plotutil.plot_2D_classes(template_mrc[templates_exclude_idx],
-                                       rows = 3, cols = 3,
-                                       figsize_each=0.6)
-        rc.set_output_group_image('templates_excluded', figgroup)
+        rc.log_plot(templates_exclude_figs['log'], 'Excluded %d classes:' % len(templates_exclude_idx))
+        rc.set_output_group_image('templates_excluded', templates_exclude_figs['group'])
 
-    if has_particles:
-        particle_selection_mask = n.in1d(particles_dset.data['alignments2D/class'], templates_selection_state)
+    if has_particles and split_class_idxs is None:
+        particle_selection_mask = selection.selection_mask(class_positions, [v['selected'] for v in class_info])
         particle_selection_mask = n.logical_and(particle_selection_mask, particles_dset.data['alignments2D/class_posterior'] > prob_thresh)
-        particle_include_idxs = n.where(particle_selection_mask)[0]
-        particle_exclude_idxs = n.where(~particle_selection_mask)[0]
-        particles_dset_include = particles_dset.subset_idxs(particle_include_idxs)
-        particles_dset_exclude = particles_dset.subset_idxs(particle_exclude_idxs)
-        rc.log('Particles selected : %d' % (len(particles_dset_include)))
-        rc.log('Particles excluded : %d' % (len(particles_dset_exclude)))
+        num_particles_include = int(n.sum(particle_selection_mask))
+        num_particles_exclude = num_particles - num_particles_include
+        rc.log('Particles selected : %d' % (num_particles_include))
+        rc.log('Particles excluded : %d' % (num_particles_exclude))
+
+        # both partitions streamed to their .cs files in chunks, without building subset datasets
+        outpath_rel_include = os.path.join(job_dir_rel, 'particles_selected.cs')
+        outpath_rel_exclude = os.path.join(job_dir_rel, 'particles_excluded.cs')
+        with timer.phase('write particles'):
+            cswriter.write_partitioned(particles_dset, particle_selection_mask,
+                                       os.path.join(proj_dir_abs, outpath_rel_include) if num_particles_include > 0 else None,
+                                       os.path.join(proj_dir_abs, outpath_rel_exclude) if num_particles_exclude > 0 else None,
+                                       ['blob', 'alignments2D'])
+
+        # previews sampled across classes for both groups, read in one batch
+        with timer.phase('read previews'):
+            particle_data_include, particle_data_exclude = preview.read_previews(particles_dset, class_positions,
+                                                                                 [particle_selection_mask, ~particle_selection_mask], proj_dir_abs)
     
-        if len(particle_include_idxs) > 0:
-            outpath_rel = os.path.join(job_dir_rel, 'particles_selected.cs')
-            particles_dset_include.filter_prefixes(['blob', 'alignments2D']).to_file(os.path.join(proj_dir_abs, outpath_rel))
-            rc.output('particles_selected', 'blob', outpath_rel, 0, len(particles_dset_include))
-            rc.output('particles_selected', 'alignments2D', outpath_rel, 0, len(particles_dset_include))
-
-            pset = particles.ParticleStack()
-            pset.init(particles_dset_include.subset_range(0,9))
-            pset.read_blobs(proj_dir_abs, do_cache=False)
-            particle_data = [p.get_original_real_data() for p in pset.get_items()]
-            
-            fig_group_included = plotutil.plot_images_simple(particle_data, rows=3, cols=3, radwn=6, figscale=0.6)
+        if num_particles_include > 0:
+            rc.output('particles_selected', 'blob', outpath_rel_include, 0, num_particles_include)
+            rc.output('particles_selected', 'alignments2D', outpath_rel_include, 0, num_particles_include)
+
+            fig_group_included = plotutil.plot_images_simple(particle_data_include, rows=3, cols=3, radwn=6, figscale=0.6)
             rc.set_output_group_image('particles_selected', fig_group_included)
 
-        if len(particle_exclude_idxs) > 0:
-            outpath_rel = os.path.join(job_dir_rel, 'particles_excluded.cs')
-            particles_dset_exclude.filter_prefixes(['blob', 'alignments2D']).to_file(os.path.join(proj_dir_abs, outpath_rel))
-            rc.output('particles_excluded', 'blob', outpath_rel, 0, len(particles_dset_exclude))
-            rc.output('particles_excluded', 'alignments2D', outpath_rel, 0, len(particles_dset_exclude))
+        if num_particles_exclude > 0:
+            rc.output('particles_excluded', 'blob', outpath_rel_exclude, 0, num_particles_exclude)
+            rc.output('particles_excluded', 'alignments2D', outpath_rel_exclude, 0, num_particles_exclude)
             
-            pset = particles.ParticleStack()
-            pset.init(particles_dset_exclude.subset_range(0,9))
-            pset.read_blobs(proj_dir_abs, do_cache=False)
-            particle_data = [p.get_original_real_data() for p in pset.get_items()]
-
-            fig_group_excluded = plotutil.plot_images_simple(particle_data, rows=3, cols=3, radwn=6, figscale=0.6)
+            fig_group_excluded = plotutil.plot_images_simple(particle_data_exclude, rows=3, cols=3, radwn=6, figscale=0.6)
             rc.set_output_group_image('particles_excluded', fig_group_excluded)
 
+    timer.log_summary()
     rc.log('Done.')
     rc.log('Interactive backend shutting down.')
 
@@ -265,79 +340,142 @@ def update_class_num_selected(class_idx):
     class_dict = get_class_info_idx(class_idx)
     if state['has_particles']:
         if class_dict['selected']:
-            num_selected = n.sum(n.logical_and(state['particles_dset'].data['alignments2D/class'] == class_idx, state['particles_dset'].data['alignments2D/class_posterior'] > state['prob_thresh']))
+            num_selected = state['posterior_index'].num_above(state['prob_thresh'], get_class_position(class_idx))
         class_dict['num_particles_selected'] = num_selected
+    mark_changed(class_idx)
+
+def mark_changed(class_idx):
+    """ give a class the next version if its selection or count changed since it was last marked """
+    position = get_class_position(class_idx)
+    class_dict = state['class_info'][position]
+    mark = (class_dict['selected'], class_dict['num_particles_selected'])
+    if state['class_marks'][position] != mark:
+        state['class_marks'][position] = mark
+        state['version'] += 1
+        state['class_versions'][position] = state['version']
     
+# Selection changes are lists of operations, applied in order by apply_ops:
+#   {'op' : 'set', 'class_idx' : 3, 'selected' : True}
+#   {'op' : 'above', 'class_idx' : 3, 'dimension' : 'res_A'}   select classes with more than class 3
+#   {'op' : 'below', 'class_idx' : 3, 'dimension' : 'res_A'}   select classes with less than class 3
+#   {'op' : 'invert'}, {'op' : 'all'}, {'op' : 'none'}
+#   {'op' : 'threshold', 'prob_thresh' : 0.5}
+# above and below compare the values from before the batch. The counts of the classes that
+# changed are recomputed once, after the last operation.
+SELECTION_OPS = ('set', 'above', 'below', 'invert', 'all', 'none', 'threshold')
+
+def check_op(op):
+    kind = op.get('op')
+    assert kind in SELECTION_OPS, 'unknown selection op %r' % (kind,)
+    if kind in ('set', 'above', 'below'):
+        assert op.get('class_idx') in state['class_position'], 'no class %r' % (op.get('class_idx'),)
+    if kind == 'set':
+        assert 'selected' in op, 'set needs selected'
+    if kind in ('above', 'below'):
+        assert op.get('dimension') in state['class_info'][0], 'unknown dimension %r' % (op.get('dimension'),)
+    if kind == 'threshold':
+        assert op.get('prob_thresh') is not None and 0.0 <= op['prob_thresh'] <= 1.0, 'prob_thresh must be in [0, 1]'
+
+def apply_ops(ops):
+    """ apply selection ops in order, all or none: every op is checked before any is applied """
+    for op in ops:
+        check_op(op)
+    class_info = state['class_info']
+    selected = [class_dict['selected'] for class_dict in class_info]
+    prob_thresh = state['prob_thresh']
+    for op in ops:
+        kind = op['op']
+        if kind == 'set':
+            selected[get_class_position(op['class_idx'])] = bool(op['selected'])
+        elif kind in ('above', 'below'):
+            dimension = op['dimension']
+            compare = get_class_info_idx(op['class_idx'])[dimension]
+            for index, class_dict in enumerate(class_info):
+                if (class_dict[dimension] > compare) if kind == 'above' else (class_dict[dimension] < compare):
+                    selected[index] = True
+        elif kind == 'invert':
+            selected = [not s for s in selected]
+        elif kind in ('all', 'none'):
+            selected = [kind == 'all'] * len(class_info)
+        elif kind == 'threshold':
+            prob_thresh = op['prob_thresh']
+    thresh_changed = prob_thresh != state['prob_thresh']
+    if thresh_changed:
+        state['prob_thresh'] = prob_thresh
+        state['version'] += 1
+    for index, class_dict in enumerate(class_info):
+        if thresh_changed or class_dict['selected'] != selected[index]:
+            class_dict['selected'] = selected[index]
+            update_class_num_selected(class_dict['class_idx'])
+    return True
+
+@extern
+def apply_selection_ops(ops):
+    return apply_ops(ops)
+
 @extern
 def select_all():
-    for class_dict in state['class_info']:
-        class_dict['selected'] = True
-        update_class_num_selected(class_dict['class_idx'])
-    return True
+    return apply_ops([{'op' : 'all'}])
 
 @extern
 def select_none():
-    for class_dict in state['class_info']:
-        class_dict['selected'] = False
-        update_class_num_selected(class_dict['class_idx'])
-    return True
+    return apply_ops([{'op' : 'none'}])
 
 @extern
 def select_invert():
-    for class_dict in state['class_info']:
-        class_dict['selected'] = not class_dict['selected']
-        update_class_num_selected(class_dict['class_idx'])
-    return True
+    return apply_ops([{'op' : 'invert'}])
 
 @extern
 def select_above(class_idx, dimension):
-    compare = get_class_info_idx(class_idx)[dimension]
-    for class_dict in state['class_info']:
-        if class_dict[dimension] > compare:
-           class_dict['selected'] = True
-           update_class_num_selected(class_dict['class_idx'])
-    return True
+    return apply_ops([{'op' : 'above', 'class_idx' : class_idx, 'dimension' : dimension}])
 
 @extern
 def select_below(class_idx, dimension):
-    compare = get_class_info_idx(class_idx)[dimension]
-    for class_dict in state['class_info']:
-        if class_dict[dimension] < compare:
-            class_dict['selected'] = True
-            update_class_num_selected(class_dict['class_idx'])
-    return True
+    return apply_ops([{'op' : 'below', 'class_idx' : class_idx, 'dimension' : dimension}])
 
 @extern
 def set_class_selected(class_idx, selected):
-    get_class_info_idx(class_idx)['selected'] = selected
-    update_class_num_selected(class_idx)
-    return True
+    return apply_ops([{'op' : 'set', 'class_idx' : class_idx, 'selected' : selected}])
 
 @extern
 def set_prob_thresh(prob_thresh):
-    assert prob_thresh >= 0.0 and prob_thresh <= 1.0
-    state['prob_thresh'] = prob_thresh
-    for class_idx in state['template_classes']:
-        update_class_num_selected(class_idx)
-    return True
+    return apply_ops([{'op' : 'threshold', 'prob_thresh' : prob_thresh}])
 
-@extern
-def get_class_info(class_idx = None):
-    if class_idx is None: 
+@extern_query
+def get_class_info(class_idx = None, since_version = None):
+    """ all classes, or with since_version {'version', 'since_version', 'class_info'} with only
+    the classes that changed after since_version (all of them if it is newer than the state) """
+    if class_idx is None and since_version is None:
         return state['class_info']
+    if class_idx is None:
+        if since_version > state['version']:
+            since_version = -1 # from before a restart
+        changed = n.nonzero(state['class_versions'] > since_version)[0]
+        return {'version' : state['version'], 'since_version' : since_version,
+                'class_info' : [state['class_info'][index] for index in changed]}
 
 def get_class_info_idx(class_idx):
-    for class_dict in state['class_info']:
-        if class_dict['class_idx']==class_idx:
-            return class_dict
+    index = state['class_position'].get(class_idx)
+    if index is not None:
+        return state['class_info'][index]
 
-@extern
+def get_class_position(class_idx):
+    return state['class_position'][class_idx]
+
+@extern_query
 def get_prob_thresh():
     return state['prob_thresh']
-@extern
+@extern_query
 def get_hist_data():
     return {'prob_hist_data' : state['prob_hist_data'], 'prob_hist_bins' : state['prob_hist_bins'], 'prob_sum_data' : state['prob_sum_data'],}
 
+@extern_query
+def get_class_hist_data(class_idx, bins = 100):
+    if not state['has_particles']:
+        return {'prob_hist_data' : [], 'prob_hist_bins' : []}
+    hist_data, hist_bins = state['posterior_index'].class_histogram(get_class_position(class_idx), bins)
+    return {'class_idx' : class_idx, 'prob_hist_data' : hist_data, 'prob_hist_bins' : hist_bins}
+
 @extern
 def finish():
     request.environ.get('werkzeug.server.shutdown')()
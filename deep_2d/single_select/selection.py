@@ -0,0 +1,88 @@
+## ---------------------------------------------------------------------------
+##    Copyright (c) 2019 Structura Biotechnology Inc. All rights reserved.
+##         Do not reproduce or redistribute, in whole or in part.
+##      Use of this code is permitted only under licence from Structura.
+##                   Contact us at info@structura.bio.
+## ---------------------------------------------------------------------------
+
+# Vectorized per-class bookkeeping for single_select.
+# Particles are mapped once to the position of their class in the template list, after
+# which counts, means and selection masks are single O(N) passes instead of one boolean
+# mask per class.
+
+import numpy as n
+
+def class_positions(class_assignments, template_classes):
+    """ position of each particle's class in template_classes, or -1 if that class has no template """
+    class_assignments = n.asarray(class_assignments).astype(n.int64)
+    template_classes = n.asarray(template_classes).astype(n.int64)
+    if len(class_assignments) == 0 or len(template_classes) == 0:
+        return n.full(len(class_assignments), -1, dtype=n.int64)
+    size = max(class_assignments.max(), template_classes.max()) + 1
+    lut = n.full(size, -1, dtype=n.int64)
+    lut[template_classes] = n.arange(len(template_classes))
+    return lut[class_assignments]
+
+def per_class_counts(positions, num_classes):
+    valid = positions >= 0
+    return n.bincount(positions[valid], minlength=num_classes)[:num_classes]
+
+def per_class_means(positions, num_classes, values, counts=None):
+    """ mean of values over the particles of each class, nan for empty classes (like n.mean of an empty slice) """
+    valid = positions >= 0
+    if counts is None:
+        counts = per_class_counts(positions, num_classes)
+    sums = n.bincount(positions[valid], weights=n.asarray(values)[valid], minlength=num_classes)[:num_classes]
+    with n.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+def selection_mask(positions, class_selected):
+    """ per particle mask of the classes flagged in class_selected (one bool per template, in template order) """
+    lut = n.zeros(len(class_selected) + 1, dtype=bool)  # the extra last entry catches position -1
+    lut[:len(class_selected)] = class_selected
+    return lut[positions]
+
+def class_members(positions, num_classes):
+    """ particle indices grouped by class: returns (order, offsets), class i is order[offsets[i]:offsets[i+1]] """
+    order = n.argsort(positions, kind='mergesort')
+    counts = n.bincount(positions[positions >= 0], minlength=num_classes)[:num_classes]
+    num_unassigned = len(positions) - counts.sum()
+    offsets = num_unassigned + n.concatenate([[0], n.cumsum(counts)])
+    return order, offsets
+
+class ClassPosteriorIndex(object):
+    """ Per-class sorted class_posterior values, built once.
+
+    num_above(t) answers "how many particles of each class have posterior > t" with one
+    binary search per class, so moving the threshold costs O(K log N) instead of a scan
+    over every particle. """
+
+    def __init__(self, positions, num_classes, posterior):
+        self.num_classes = num_classes
+        posterior = n.asarray(posterior)
+        valid = positions >= 0
+        # sort by class, then by posterior within each class: one argsort of class * span + posterior,
+        # with span wider than the posterior range, is several times faster than lexsort of both
+        valid_posterior = posterior[valid]
+        low = float(valid_posterior.min()) if len(valid_posterior) > 0 else 0.0
+        span = float(valid_posterior.max()) - low + 1.0 if len(valid_posterior) > 0 else 1.0
+        order = n.argsort(positions[valid] * span + (valid_posterior - low))
+        self.sorted_posterior = valid_posterior[order]
+        self.counts = n.bincount(positions[valid], minlength=num_classes)[:num_classes]
+        self.offsets = n.concatenate([[0], n.cumsum(self.counts)])
+
+    def class_posterior(self, index):
+        """ sorted posteriors of the class at template position index """
+        return self.sorted_posterior[self.offsets[index]:self.offsets[index+1]]
+
+    def num_above(self, prob_thresh, index=None):
+        """ number of particles with posterior > prob_thresh, for one class position or all of them """
+        # in the posterior dtype, as posterior > prob_thresh compares it when the outputs are written
+        prob_thresh = self.sorted_posterior.dtype.type(prob_thresh)
+        if index is not None:
+            post = self.class_posterior(index)
+            return len(post) - n.searchsorted(post, prob_thresh, side='right')
+        return n.array([self.num_above(prob_thresh, i) for i in range(self.num_classes)], dtype=n.int64)
+
+    def class_histogram(self, index, bins=100):
+        return n.histogram(self.class_posterior(index), bins, range=(0,1))
@@ -0,0 +1,343 @@
+import os
+import sys
+import json
+import time
+import errno
+import runpy
+import random
+import select
+import signal
+import socket
+import argparse
+import importlib
+import traceback
+import collections
+
+# Warm runner: starts jobs by forking an already-warm process instead of a new python.
+#
+# A job process normally starts as `python -m cryosparc_compute.run ...` and pays for its
+# imports every time: for single_select that is flask, numpy, matplotlib (plotutil) and
+# the particles stack, which takes longer than the selection work of a small job. The
+# warm runner imports all of that once, then forks a child per job:
+#
+#   python warmrunner.py serve --socket /tmp/warmrunner.sock --job_types single_select
+#   python warmrunner.py run --socket /tmp/warmrunner.sock -- --project P1 --job J2 ...
+#
+# `serve` imports --preload modules and the run modules of --job_types (through
+# jobregister), then listens on a unix socket. `run` sends its arguments, working dir and
+# environment; the server forks, and the child sets sys.argv and runs the --entry module
+# (cryosparc_compute.run by default) as __main__, exactly as `python -m` would. The
+# child's stdout and stderr come back over the socket and are written to run's own, and
+# run exits with the child's exit code; SIGTERM/SIGINT/SIGHUP to run are passed on to the
+# child, so killing the job still works. When no server is listening, run starts the
+# entry in its own process (a cold start), so the runner is always optional.
+#
+# Children run in their own session and outlive the server. Only the user that owns the
+# socket can connect to it.
+
+DEFAULT_ENTRY = 'cryosparc_compute.run'
+FORWARDED_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+
+
+def _native(s):
+  """ json gives unicode on py2; environ and argv want str there """
+  if not isinstance(s, str):
+    s = s.encode('utf-8')
+  return s
+
+
+def _send(conn, msg):
+  conn.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+
+
+def _read_line(conn):
+  """ one line from conn, plus whatever was read past it """
+  buf = b''
+  while b'\n' not in buf:
+    data = _recv(conn)
+    if not data:
+      raise IOError('warm runner closed the connection')
+    buf += data
+  line, _, rest = buf.partition(b'\n')
+  return json.loads(line.decode('utf-8')), rest
+
+
+def _recv(conn, size=65536):
+  while True:
+    try:
+      return conn.recv(size)
+    except socket.error as e:
+      if e.errno != errno.EINTR: # py2 does not retry after a forwarded signal
+        raise
+
+
+def _connect(socket_path, timeout=None):
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  conn.settimeout(timeout)
+  try:
+    conn.connect(socket_path)
+  except socket.error:
+    conn.close()
+    raise
+  return conn
+
+
+def _exit_code(e):
+  """ the exit code python gives a SystemExit """
+  if e.code is None:
+    return 0
+  if isinstance(e.code, int):
+    return e.code
+  sys.stderr.write('%s\n' % (e.code,))
+  return 1
+
+
+def launch(entry, argv):
+  """ run module entry as __main__ with argv, as `python -m entry argv` would; returns the exit code """
+  sys.argv = [entry] + list(argv)
+  if sys.path[:1] != ['']:
+    sys.path.insert(0, '') # python -m looks in the working dir first
+  try:
+    runpy.run_module(entry, run_name='__main__', alter_sys=True)
+  except SystemExit as e:
+    return _exit_code(e)
+  except Exception:
+    traceback.print_exc()
+    return 1
+  return 0
+
+
+class WarmRunner(object):
+
+  def __init__(self, socket_path, entry=DEFAULT_ENTRY, preload=(), job_types=(), max_exited=1000):
+    self.socket_path = socket_path
+    self.entry = entry
+    self.preload = list(preload)
+    self.job_types = list(job_types)
+    self.max_exited = max_exited
+    self.children = set()
+    self.exited = collections.OrderedDict() # pid -> exit code, newest last
+    self.waiting = {}                       # pid -> connections waiting for its exit code
+    self.listener = None
+
+  def warm_up(self):
+    """ import everything the children will need; returns the seconds it took """
+    tic = time.time()
+    for name in self.preload:
+      importlib.import_module(name)
+    if self.job_types:
+      jobregister = importlib.import_module('cryosparc_compute.jobs.jobregister')
+      jobregister.check_all_job_modules()
+      for job_type in self.job_types:
+        jobregister.get_run_function(job_type)
+    return time.time() - tic
+
+  def listen(self):
+    if os.path.exists(self.socket_path):
+      try:
+        _connect(self.socket_path, timeout=1).close()
+      except socket.error:
+        os.remove(self.socket_path) # left behind by a server that died
+      else:
+        raise RuntimeError('a warm runner is already listening on %s' % self.socket_path)
+    self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+      self.listener.bind(self.socket_path)
+    finally:
+      os.umask(old_umask)
+    self.listener.listen(64)
+
+  def serve_forever(self, poll_interval=0.2):
+    try:
+      while True:
+        try:
+          readable, _, _ = select.select([self.listener], [], [], poll_interval)
+        except select.error as e:
+          if e.args[0] != errno.EINTR:
+            raise
+          readable = []
+        if readable:
+          conn, _ = self.listener.accept()
+          try:
+            self.handle(conn)
+          except Exception:
+            traceback.print_exc()
+            conn.close()
+        self.reap()
+    finally:
+      self.close()
+
+  def close(self):
+    if self.listener is not None:
+      self.listener.close()
+      self.listener = None
+      if os.path.exists(self.socket_path):
+        os.remove(self.socket_path)
+
+  def handle(self, conn):
+    conn.settimeout(10)
+    req, _ = _read_line(conn)
+    if 'wait' in req:
+      pid = req['wait']
+      if pid in self.exited:
+        _send(conn, {'returncode': self.exited[pid]})
+        conn.close()
+      elif pid in self.children:
+        self.waiting.setdefault(pid, []).append(conn)
+      else:
+        _send(conn, {'error': 'no job with pid %d' % pid})
+        conn.close()
+      return
+    if 'ping' in req:
+      _send(conn, {'pid': os.getpid(), 'entry': self.entry, 'running': len(self.children)})
+      conn.close()
+      return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+      self.child(conn, req)
+    self.children.add(pid)
+    conn.close() # the child has its own copy, and sends its pid itself
+    print('warm runner: started %d: %s %s' % (pid, req.get('entry') or self.entry, ' '.join(req['argv'])))
+    sys.stdout.flush()
+
+  def child(self, conn, req):
+    """ in the forked child: become the job. Never returns. """
+    code = 1
+    try:
+      self.listener.close()
+      for signum in FORWARDED_SIGNALS + (signal.SIGCHLD,):
+        signal.signal(signum, signal.SIG_DFL)
+      os.setsid()
+      conn.settimeout(None)
+      _send(conn, {'pid': os.getpid()})
+      devnull = os.open(os.devnull, os.O_RDONLY)
+      os.dup2(devnull, 0)
+      os.dup2(conn.fileno(), 1)
+      os.dup2(conn.fileno(), 2)
+      os.close(devnull)
+      conn.close()
+      os.chdir(req['cwd'])
+      os.environ.clear()
+      os.environ.update(dict((_native(k), _native(v)) for k, v in req['env'].items()))
+      # every child would otherwise draw the same random numbers as its siblings
+      random.seed()
+      if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed()
+      code = launch(_native(req.get('entry') or self.entry), [_native(a) for a in req['argv']])
+    except SystemExit as e:
+      code = _exit_code(e)
+    except BaseException:
+      traceback.print_exc()
+    finally:
+      try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+      finally:
+        os._exit(code)
+
+  def reap(self):
+    while self.children:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        break
+      if pid == 0:
+        break
+      code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+      self.children.discard(pid)
+      self.exited[pid] = code
+      while len(self.exited) > self.max_exited:
+        self.exited.popitem(last=False)
+      for conn in self.waiting.pop(pid, []):
+        try:
+          _send(conn, {'returncode': code})
+        except socket.error:
+          pass
+        conn.close()
+      print('warm runner: %d exited with %d' % (pid, code))
+      sys.stdout.flush()
+
+
+def run_client(socket_path, entry, argv, out_fd=1):
+  """ run a job through the warm runner at socket_path. Returns its exit code, or None if
+  no runner is listening (then nothing was started). """
+  try:
+    conn = _connect(socket_path)
+  except socket.error as e:
+    if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+      return None
+    raise
+  _send(conn, {'entry': entry, 'argv': list(argv), 'cwd': os.getcwd(), 'env': dict(os.environ)})
+  header, rest = _read_line(conn)
+  pid = header['pid']
+
+  def forward(signum, frame):
+    try:
+      os.kill(pid, signum)
+    except OSError:
+      pass
+  previous = dict((signum, signal.signal(signum, forward)) for signum in FORWARDED_SIGNALS)
+  try:
+    if rest:
+      os.write(out_fd, rest)
+    while True:
+      data = _recv(conn)
+      if not data:
+        break
+      os.write(out_fd, data)
+    conn.close()
+    conn = _connect(socket_path)
+    _send(conn, {'wait': pid})
+    reply, _ = _read_line(conn)
+    conn.close()
+  finally:
+    for signum, handler in previous.items():
+      signal.signal(signum, handler)
+  if 'error' in reply:
+    raise RuntimeError('warm runner: %s' % reply['error'])
+  return reply['returncode']
+
+
+def main(argv):
+  parser = argparse.ArgumentParser()
+  sub = parser.add_subparsers(dest='command')
+  serve = sub.add_parser('serve', help='import the run modules once and fork a child per job')
+  serve.add_argument('--socket', type=str, required=True)
+  serve.add_argument('--entry', type=str, default=DEFAULT_ENTRY, help='module each job runs as __main__')
+  serve.add_argument('--preload', type=str, nargs='*', default=[], help='modules to import up front')
+  serve.add_argument('--job_types', type=str, nargs='*', default=[], help='job types whose run modules to import up front (needs cryoSPARC)')
+  run = sub.add_parser('run', help='start a job through the warm runner, or in this process if none is listening')
+  run.add_argument('--socket', type=str, required=True)
+  run.add_argument('--entry', type=str, default=DEFAULT_ENTRY)
+  if '--' in argv:
+    argv, job_argv = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+  else:
+    job_argv = []
+  args = parser.parse_args(argv)
+
+  if args.command == 'serve':
+    runner = WarmRunner(args.socket, args.entry, args.preload, args.job_types)
+    print('warm runner: imported %s in %.2f s' % (', '.join(args.preload + args.job_types) or 'nothing', runner.warm_up()))
+    runner.listen()
+    print('warm runner: listening on %s' % args.socket)
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+      runner.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    return 0
+
+  code = run_client(args.socket, args.entry, job_argv)
+  if code is None:
+    return launch(args.entry, job_argv) # cold start
+  return code if code >= 0 else 128 - code # killed by a signal, as a shell reports it
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))